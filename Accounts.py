@@ -0,0 +1,84 @@
+import sqlite3
+import time
+
+from CanvasClient import CanvasClient
+from CourseRegistry import CourseRegistry
+
+
+# One Canvas login: a member's token with its own connection pool, rate-limit budget and course list
+class CanvasAccount:
+    def __init__(self, owner_id, token, registry=None, store=None):
+        # Discord id of the member who linked the token, 0 for the bot's own CANVAS_API_TOKEN
+        self.owner_id = owner_id
+        self.client = CanvasClient(token)
+        self.registry = registry or CourseRegistry(None)
+        # Where the course list is saved, None when it lives in student_courses.json
+        self.store = store
+        # Canvas id of the token's user, looked up the first time it's needed
+        self.canvas_user_id = None
+
+    @property
+    def is_default(self):
+        return self.owner_id == 0
+
+    def save_courses(self, courses):
+        self.registry.update(courses)
+        if self.store is not None:
+            self.store.save_courses(self.owner_id, courses)
+
+    async def close(self):
+        await self.client.close()
+
+
+# Linked tokens and their course lists, in the same SQLite file as the seen ids and preferences.
+# Tokens are stored as given, so the state file should only be readable by the bot's user
+class AccountStore:
+    def __init__(self, path="bot_state.db"):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS accounts (owner_id INTEGER PRIMARY KEY, token TEXT NOT NULL, linked_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS account_courses ("
+            "owner_id INTEGER NOT NULL, course_id INTEGER NOT NULL, name TEXT NOT NULL, "
+            "PRIMARY KEY (owner_id, course_id))"
+        )
+        self.conn.commit()
+
+    def load(self):
+        # Every linked account as (owner_id, token, courses), two queries in total
+        courses = {}
+        for owner_id, course_id, name in self.conn.execute(
+            "SELECT owner_id, course_id, name FROM account_courses ORDER BY owner_id, rowid"
+        ):
+            courses.setdefault(owner_id, []).append({"id": course_id, "name": name})
+        return [
+            (owner_id, token, courses.get(owner_id, []))
+            for owner_id, token in self.conn.execute("SELECT owner_id, token FROM accounts")
+        ]
+
+    def save_account(self, owner_id, token):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO accounts (owner_id, token, linked_at) VALUES (?, ?, ?)",
+                (owner_id, token, time.time()),
+            )
+
+    def save_courses(self, owner_id, courses):
+        with self.conn:
+            self.conn.execute("DELETE FROM account_courses WHERE owner_id = ?", (owner_id,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO account_courses (owner_id, course_id, name) VALUES (?, ?, ?)",
+                [(owner_id, course["id"], course["name"]) for course in courses],
+            )
+
+    def remove_account(self, owner_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM accounts WHERE owner_id = ?", (owner_id,))
+            self.conn.execute("DELETE FROM account_courses WHERE owner_id = ?", (owner_id,))
+
+    def close(self):
+        self.conn.close()
@@ -1,10 +1,14 @@
-from datetime import datetime, timedelta
+import asyncio
+from datetime import timedelta
 import json
-import pytz
 from os import getenv
 from dotenv import load_dotenv
 
-import requests
+from Accounts import CanvasAccount
+from Cache import TTLCache
+from CanvasClient import PageFetchError
+from CourseRegistry import CourseRegistry
+import TimeUtil
 
 load_dotenv()
 CANVAS_API_URL = getenv('CANVAS_API_URL')
@@ -12,22 +16,163 @@ CANVAS_API_TOKEN = getenv('CANVAS_API_TOKEN')
 DISCORD_CHANNEL_ID = int(getenv("DISCORD_CHANNEL_ID", 0))
 BOT_TOKEN = getenv('BOT_TOKEN')
 
-USER_TIMEZONE = pytz.timezone("America/Los_Angeles")
-USER_TIMEZONE_PLUS = pytz.timezone("America/Denver")
+# Page size for Canvas list endpoints (Canvas defaults to 10)
+CANVAS_PER_PAGE = int(getenv("CANVAS_PER_PAGE", 100))
+# How many courses aggregate operations fetch at the same time
+CANVAS_CONCURRENCY = int(getenv("CANVAS_CONCURRENCY", 5))
+
+# Process-wide course list, loaded once from student_courses.json
+course_registry = CourseRegistry("student_courses.json")
+
+# Full assignment records keyed by (course_id, assignment_id)
+assignment_cache = TTLCache(
+    maxsize=int(getenv("ASSIGNMENT_CACHE_SIZE", 2048)),
+    ttl=int(getenv("ASSIGNMENT_CACHE_TTL", 900)),
+)
+
+# Canvas user profiles keyed by user id, shared with DiscordBot
+user_cache = TTLCache(
+    maxsize=int(getenv("USER_CACHE_SIZE", 512)),
+    ttl=int(getenv("USER_CACHE_TTL", 3600)),
+)
+
+# Each account's current grades per course keyed by owner id, short-lived and cleared when a new grade is seen
+grade_cache = TTLCache(maxsize=int(getenv("GRADE_CACHE_SIZE", 256)), ttl=int(getenv("GRADE_CACHE_TTL", 300)))
+
+# The bot's own token and course file, used for anyone who hasn't linked their own Canvas token
+default_account = CanvasAccount(0, CANVAS_API_TOKEN, registry=course_registry)
+canvas_client = default_account.client
+# Owner id -> account, every account has its own client and rate-limit budget
+accounts = {0: default_account}
+
+def get_account(owner_id):
+    return accounts.get(owner_id)
+
+def account_for(user_id):
+    # A member's own linked account, or the bot's account if they haven't linked one
+    return accounts.get(user_id) or default_account
+
+def linked_accounts():
+    return [account for account in accounts.values() if not account.is_default]
+
+def accounts_for_course(course_id):
+    return [account for account in accounts.values() if account.registry.name_for(course_id) is not None]
+
+def load_accounts(store):
+    # Recreate every linked account from the shared store at startup
+    for owner_id, token, courses in store.load():
+        accounts[owner_id] = CanvasAccount(owner_id, token, registry=CourseRegistry(None, courses=courses), store=store)
+    return linked_accounts()
+
+async def link_account(owner_id, token, store):
+    """Check a member's token against Canvas and start using it, returns the account or None if the token doesn't work."""
+    account = CanvasAccount(owner_id, token, store=store)
+    profile = await make_api_request(f"{CANVAS_API_URL}/users/self", account=account)
+    if not profile:
+        await account.close()
+        return None
+    account.canvas_user_id = profile.get("id")
+    previous = accounts.get(owner_id)
+    accounts[owner_id] = account
+    store.save_account(owner_id, token)
+    if previous is not None and not previous.is_default:
+        await previous.close()
+    invalidate_current_grades(account)
+    await fetch_student_courses(account)
+    return account
+
+async def unlink_account(owner_id, store):
+    account = accounts.pop(owner_id, None) if owner_id else None
+    store.remove_account(owner_id)
+    if account is not None:
+        invalidate_current_grades(account)
+        await account.close()
+    return account is not None
+
+async def account_with_token(owner_id, token):
+    # The account for an owner and token, replacing one whose token has changed since, e.g. in a polling worker
+    account = accounts.get(owner_id)
+    if account is not None and account.client.token == token:
+        return account
+    accounts[owner_id] = CanvasAccount(owner_id, token, registry=account.registry if account else None)
+    if account is not None and not account.is_default:
+        await account.close()
+    return accounts[owner_id]
+
+async def get_canvas_user_id(account=None):
+    # The Canvas user behind a token, looked up once per account
+    account = account or default_account
+    if account.canvas_user_id is None:
+        profile = await make_api_request(f"{CANVAS_API_URL}/users/self", account=account)
+        if profile:
+            account.canvas_user_id = profile.get("id")
+    return account.canvas_user_id
+
+# Canvas API Helper Functions, `account` defaults to the bot's own
+async def make_api_request(endpoint, params=None, account=None):
+    return await (account or default_account).client.get(endpoint, params)
+
+def paginate_api_request(endpoint, params=None, per_page=None, account=None):
+    # Async iterator over every item of a paginated list endpoint, break out of it to stop early
+    return (account or default_account).client.paginate(endpoint, params, per_page or CANVAS_PER_PAGE)
+
+async def fetch_all_pages(endpoint, params=None, per_page=None, account=None):
+    return [item async for item in paginate_api_request(endpoint, params, per_page, account)]
+
+async def gather_courses(course_ids, fetch, limit=None):
+    """
+    Runs fetch(course_id) for every course concurrently, at most `limit` at a time.
+    Results come back in course_ids order, a course that fails gives None instead of failing the rest.
+    """
+    semaphore = asyncio.Semaphore(limit or CANVAS_CONCURRENCY)
+
+    async def run(course_id):
+        async with semaphore:
+            try:
+                return await fetch(course_id)
+            except Exception as e:
+                print(f"Error fetching data for course {course_id}: {e}")
+                return None
+
+    return await asyncio.gather(*(run(course_id) for course_id in course_ids))
+
+def get_rate_limit_state(account=None):
+    return (account or default_account).client.governor.state()
+
+def rate_limit_is_low(account=None):
+    # Lets polling back off before Canvas starts throttling us, each token has its own budget
+    return (account or default_account).client.governor.is_low()
+
+def get_cache_stats():
+    # Hit/miss counts for the lookup caches, response caches summed over every account
+    responses = {"size": 0, "maxsize": 0, "hits": 0, "misses": 0}
+    for account in accounts.values():
+        stats = account.client.cache_stats()
+        for key in responses:
+            responses[key] += stats[key]
+    lookups = responses["hits"] + responses["misses"]
+    responses["hit_rate"] = responses["hits"] / lookups if lookups else 0.0
+    return {
+        "assignments": assignment_cache.stats(),
+        "users": user_cache.stats(),
+        "grades": grade_cache.stats(),
+        "responses": responses,
+    }
 
-# Canvas API Helper Functions
-def make_api_request(endpoint, params=None):
-    headers = {"Authorization": f"Bearer {CANVAS_API_TOKEN}"}
-    response = requests.get(endpoint, headers=headers, params=params or {})
-    if response.status_code == 200:
-        return response.json()
-    print(f"Error fetching data from {endpoint}: {response.status_code}")
-    return None
+async def close_canvas_client():
+    for account in list(accounts.values()):
+        await account.close()
 
-def fetch_student_courses():
+async def fetch_student_courses(account=None):
+    account = account or default_account
     endpoint = f"{CANVAS_API_URL}/courses"
     params = {"enrollment_type": "student"}  # Filter for courses where the user is enrolled as a student
-    courses = make_api_request(endpoint, params)
+    try:
+        courses = await fetch_all_pages(endpoint, params, account=account)
+    except PageFetchError as e:
+        # Keep the saved list rather than replacing it with part of one
+        print(f"Error fetching courses: {e}")
+        return
 
     if not courses:
         print("No courses found or error fetching courses.")
@@ -39,76 +184,78 @@ def fetch_student_courses():
         for course in courses
     ]
 
+    # Linked accounts keep their courses in the account store
+    if not account.is_default:
+        account.save_courses(course_data)
+        return
+
     # Store the courses locally in a JSON file
     try:
         with open("student_courses.json", "w") as file:
             json.dump(course_data, file, indent=4)
         print("Courses saved successfully to student_courses.json")
+        course_registry.update(course_data)
     except Exception as e:
         print(f"Error saving courses to file: {e}")
 
-def get_course_names():
-    try:
-        with open("student_courses.json", "r") as file:
-            courses = json.load(file)
-        return [course["name"] for course in courses]
-    except FileNotFoundError:
-        print("No courses file found. Please fetch courses first.")
-        return []
-    except Exception as e:
-        print(f"Error reading courses file: {e}")
-        return []
+def get_course_names(account=None):
+    return (account or default_account).registry.names()
 
-def get_course_ids():
-    try:
-        with open("student_courses.json", "r") as file:
-            courses = json.load(file)
-        return [course["id"] for course in courses]
-    except FileNotFoundError:
-        print("No courses file found. Please fetch courses first.")
-        return []
-    except Exception as e:
-        print(f"Error reading courses file: {e}")
-        return []
+def get_course_ids(account=None):
+    return (account or default_account).registry.ids()
 
-def get_course_by_id(course_id):
-    try:
-        with open("student_courses.json", "r") as file:
-            courses = json.load(file)
-        for course in courses:
-            if course["id"] == course_id:
-                return course["name"]
+def get_course_by_id(course_id, account=None):
+    course_name = (account or default_account).registry.name_for(course_id)
+    if course_name is None:
+        # Shared notifications can be about a course only a linked account is in
+        for other in accounts.values():
+            course_name = other.registry.name_for(course_id)
+            if course_name is not None:
+                return course_name
         print("Course ID not found.")
-        return None
-    except FileNotFoundError:
-        print("No courses file found. Please fetch courses first.")
-        return None
-    except Exception as e:
-        print(f"Error reading courses file: {e}")
-        return None
-
-def get_current_grade(course_id):
-    endpoint = f"{CANVAS_API_URL}/courses/{course_id}/enrollments"
-    enrollments = make_api_request(endpoint)
-
-    if not enrollments:
-        print("No enrollment data found for the course.")
-        return None
-
-    #print(f"Enrollments API response: {enrollments}")
-
-    for enrollment in enrollments:
-        # Check for the correct enrollment type and that grades exist
-        if enrollment.get("type") == "StudentEnrollment" and enrollment.get("grades"):
-            grades = enrollment["grades"]
-            current_score = grades.get("current_score")
+    return course_name
+
+def get_course_id_by_name(course_name, account=None):
+    return (account or default_account).registry.id_for(course_name)
+
+async def fetch_current_grades(account=None):
+    """
+    Current grade for every course from the calling user's own enrollments, in one request.
+    Returns {course_id: (letter grade, current score)}, cached for a short time.
+    """
+    account = account or default_account
+
+    async def fetch():
+        endpoint = f"{CANVAS_API_URL}/users/self/enrollments"
+        params = [("type[]", "StudentEnrollment"), ("state[]", "active")]
+        try:
+            enrollments = await fetch_all_pages(endpoint, params, account=account)
+        except PageFetchError as e:
+            print(f"Error fetching enrollments: {e}")
+            return None
+        if not enrollments:
+            print("No enrollment data found.")
+            return None
+
+        grades = {}
+        for enrollment in enrollments:
+            current_score = (enrollment.get("grades") or {}).get("current_score")
             if current_score is None:
                 current_score = 100.0
-            # Prefer current_grade if available, fallback to current_score
-            return convert_score_to_grade(current_score), current_score
+            grades[enrollment["course_id"]] = (convert_score_to_grade(current_score), current_score)
+        return grades
+
+    return await grade_cache.get_or_fetch(account.owner_id, fetch) or {}
+
+def invalidate_current_grades(account=None):
+    # Called when a new grade shows up so the next lookup refetches
+    grade_cache.pop((account or default_account).owner_id)
 
-    print("No grade data available for the course.")
-    return None
+async def get_current_grade(course_id, account=None):
+    grade = (await fetch_current_grades(account)).get(course_id)
+    if grade is None:
+        print("No grade data available for the course.")
+    return grade
 
 def convert_score_to_grade(score):
     if score >= 90:
@@ -122,8 +269,8 @@ def convert_score_to_grade(score):
     else:
         return "F"
 
-def calculate_gpa():
-    course_ids = get_course_ids()
+async def calculate_gpa(account=None):
+    course_ids = get_course_ids(account)
     if not course_ids:
         print("No courses available to calculate GPA.")
         return None
@@ -140,8 +287,11 @@ def calculate_gpa():
         "F": 0.0
     }
 
+    current_grades = await fetch_current_grades(account)
     for course_id in course_ids:
-        letterGrade, grade = get_current_grade(course_id)
+        if course_id not in current_grades:
+            continue
+        letterGrade, grade = current_grades[course_id]
         if letterGrade and letterGrade in grade_to_points:
             if grade:
                 total_percent += grade
@@ -156,129 +306,161 @@ def calculate_gpa():
     gpa = total_points / total_courses
     return gpa, average_percent
 
-# Canvas API Helper Functions
-def make_api_request(endpoint, params=None):
-    headers = {"Authorization": f"Bearer {CANVAS_API_TOKEN}"}
-    response = requests.get(endpoint, headers=headers, params=params or {})
-    if response.status_code == 200:
-        return response.json()
-    print(f"Error fetching data from {endpoint}: {response.status_code}")
-    return None
 
-
-def fetch_upcoming_assignments(course_ids):
+async def fetch_upcoming_assignments(course_ids, tz=None, account=None):
     # Define today's date and the date 7 days from now in UTC
-    today = datetime.now(pytz.utc)  # Current time in UTC
+    today = TimeUtil.now_utc()
     one_week_later = today + timedelta(weeks=1)
 
+    # Fetch every course at once and keep the results in course order
+    results = await gather_courses(
+        course_ids, lambda course_id: fetch_course_upcoming_assignments(course_id, today, one_week_later, tz, account)
+    )
+    return [assignment for assignments in results if assignments for assignment in assignments]
+
+async def fetch_course_upcoming_assignments(course_id, today, one_week_later, tz=None, account=None):
     upcoming_assignments = []
 
-    for course_id in course_ids:
-        # Fetch assignments for each course
-        endpoint = f"{CANVAS_API_URL}/courses/{course_id}/assignments"
-        params = {"include[]": "submission"}
-        assignments = make_api_request(endpoint, params)
-
-        if assignments:
-            # Filter assignments that are due within the next week
-            for assignment in assignments:
-                due_date_str = assignment.get("due_at")
-                submission = assignment.get("submission", {})
-
-                if submission.get("grade") is None and submission.get("submitted_at") is None and due_date_str:
-                    # Parse the due date from Canvas in UTC
-                    due_date_utc = datetime.strptime(due_date_str, "%Y-%m-%dT%H:%M:%SZ")
-                    due_date_utc = pytz.utc.localize(due_date_utc)  # Localize the UTC time
-
-                    # Convert the due date to the user's local time zone (Pacific Time)
-                    due_date_local = due_date_utc.astimezone(USER_TIMEZONE_PLUS)
-
-                    # Only include assignments due within the next week in the local time zone
-                    if today <= due_date_local <= one_week_later:
-                        # Format the due date to a more readable format
-                        formatted_due_date = due_date_utc.astimezone(USER_TIMEZONE_PLUS).strftime("%B %d, %Y, %I:%M %p")
-
-                        upcoming_assignments.append({
-                            "course": assignment["course_id"],
-                            "assignment": assignment["name"],
-                            "due_date": formatted_due_date,
-                            "link": assignment.get("html_url", "")
-                        })
+    # Fetch assignments for the course, soonest due first so we can stop past the window
+    endpoint = f"{CANVAS_API_URL}/courses/{course_id}/assignments"
+    params = {"include[]": "submission", "bucket": "future", "order_by": "due_at"}
+
+    # Filter assignments that are due within the next week
+    async for assignment in paginate_api_request(endpoint, params, account=account):
+        due_date_str = assignment.get("due_at")
+        if not due_date_str:
+            continue
+
+        # Parse the due date from Canvas in UTC
+        due_date_utc = TimeUtil.parse_canvas_time(due_date_str)
+        if due_date_utc is None:
+            continue
+
+        # Results are ordered by due date, so everything after this is outside the window
+        if due_date_utc > one_week_later:
+            break
+
+        submission = assignment.get("submission") or {}
+        if submission.get("grade") is None and submission.get("submitted_at") is None:
+            # Only include assignments due within the next week
+            if today <= due_date_utc <= one_week_later:
+                upcoming_assignments.append({
+                    "course": assignment["course_id"],
+                    "assignment": assignment["name"],
+                    "due_at": due_date_utc,
+                    # Shown in the requesting user's timezone
+                    "due_date": TimeUtil.format_local(due_date_utc, tz=tz),
+                    "link": assignment.get("html_url", "")
+                })
 
     return upcoming_assignments
 
-def fetch_recent_grades(course_id):
+async def fetch_graded_submissions(course_id, graded_since, account=None):
+    """
+    Submissions graded since `graded_since` with their assignment, user and comments side-loaded,
+    so building a grade notification needs no further requests.
+    """
     endpoint = f"{CANVAS_API_URL}/courses/{course_id}/students/submissions"
-    submissions = make_api_request(endpoint)
+    params = [
+        ("graded_since", graded_since),
+        ("include[]", "assignment"),
+        ("include[]", "user"),
+        ("include[]", "submission_comments"),
+    ]
+    submissions = await fetch_all_pages(endpoint, params, account=account)
+
+    # Share the side-loaded records with the lookup caches
+    for submission in submissions:
+        if submission.get("assignment"):
+            assignment_cache.set((course_id, submission["assignment_id"]), submission["assignment"])
+        if submission.get("user"):
+            user_cache.set(submission["user_id"], submission["user"])
+    return submissions
+
+async def build_grade_record(course_id, submission, account=None):
+    # Pull the details for a grade out of a submission, only falling back to lookups if nothing was side-loaded
+    assignment_id = submission.get("assignment_id")
+    user_id = submission.get("user_id")
+    assignment = submission.get("assignment") or await get_assignment(course_id, assignment_id, account) or {}
+    user = submission.get("user") or await get_user(user_id, account) or {}
+
+    if "submission_comments" in submission:
+        comments = submission["submission_comments"] or []
+    else:
+        comments = await fetch_submission_comments(course_id, assignment_id, user_id, account)
+
+    return {
+        "assignment_name": assignment.get("name", "Unnamed Assignment"),
+        "student_name": user.get("name", "Unknown Student"),
+        "grade": submission.get("grade"),
+        "score": submission.get("score", 0),
+        "max_points": assignment.get("points_possible", 0),
+        "comments": comments,
+        "link": submission.get("preview_url", ""),
+        "graded_at": submission.get("graded_at"),
+    }
 
-    if not submissions:
-        return []
+async def fetch_recent_grades(course_id, tz=None, account=None):
+    tz = tz or TimeUtil.get_timezone()
+    three_days_ago = TimeUtil.now_utc() - timedelta(days=3)
+    # Canvas filters on graded_since server side, so this is one paginated request for the course
+    submissions = await fetch_graded_submissions(course_id, TimeUtil.format_canvas_time(three_days_ago), account)
 
     recent_grades = []
-    three_days_ago = datetime.now(pytz.utc) - timedelta(days=3)
-
     for submission in submissions:
-        graded_at_str = submission.get("graded_at")
-        if graded_at_str:
-            graded_at = datetime.strptime(graded_at_str, "%Y-%m-%dT%H:%M:%SZ")
-            graded_at = pytz.utc.localize(graded_at)
-
-            if graded_at >= three_days_ago:
-                assignment_id = submission.get("assignment_id")
-                assignment_name = get_assignment_name(course_id, assignment_id)
-
-                user_id = submission.get("user_id")
-                student_name = get_student_name(user_id)
-
-                grade = submission.get("grade")
-                score = submission.get("score", 0)
-
-                # Fetch max points for the assignment
-                max_points = get_assignment_max_points(course_id, assignment_id)
-                formatted_grade = f"{score}/{max_points}" if max_points else grade
-
-                # Fetch submission comments
-                comments = submission.get('submission_comments', [])
-
-                # Fetch comments if they are not included
-                if not comments:
-                    comments = fetch_submission_comments(course_id, submission['assignment_id'], submission['user_id'])
-
-                # Format comments
-                formatted_comments = "\n".join(
-                    f"- {comment['author_name']} ({comment['created_at']}): {comment['comment']}"
-                    for comment in comments
-                ) or "No comments"
-
-                link = submission.get("preview_url", "")
-
-                recent_grades.append({
-                    "assignment_name": assignment_name,
-                    "student_name": student_name,
-                    "grade": formatted_grade,
-                    "comments": formatted_comments,
-                    "link": link,
-                    "graded_at": graded_at.astimezone(USER_TIMEZONE).strftime("%B %d, %Y, %I:%M %p")
-                })
+        if not submission.get("graded_at"):
+            continue
+
+        record = await build_grade_record(course_id, submission, account)
+        graded_at = TimeUtil.parse_canvas_time(record["graded_at"])
+        max_points = record["max_points"]
+        formatted_grade = f"{record['score']}/{max_points}" if max_points else record["grade"]
+
+        # Format comments, converting all their timestamps in one pass
+        comment_times = TimeUtil.localize_all((comment.get("created_at") for comment in record["comments"]), tz)
+        formatted_comments = "\n".join(
+            f"- {comment['author_name']} ({local.strftime(TimeUtil.DISPLAY_FORMAT) if local else comment.get('created_at')}): {comment['comment']}"
+            for comment, local in zip(record["comments"], comment_times)
+        ) or "No comments"
+
+        recent_grades.append({
+            "assignment_name": record["assignment_name"],
+            "student_name": record["student_name"],
+            "grade": formatted_grade,
+            "comments": formatted_comments,
+            "link": record["link"],
+            "graded_at": TimeUtil.format_local(graded_at, tz=tz) if graded_at else record["graded_at"]
+        })
 
     return recent_grades
 
-def get_assignment_name(course_id, assignment_id):
-    endpoint = f"{CANVAS_API_URL}/courses/{course_id}/assignments/{assignment_id}"
-    assignment_data = make_api_request(endpoint)
+async def get_assignment(course_id, assignment_id, account=None):
+    async def fetch():
+        endpoint = f"{CANVAS_API_URL}/courses/{course_id}/assignments/{assignment_id}"
+        return await make_api_request(endpoint, account=account)
+
+    return await assignment_cache.get_or_fetch((course_id, assignment_id), fetch)
+
+async def get_assignment_name(course_id, assignment_id, account=None):
+    assignment_data = await get_assignment(course_id, assignment_id, account) or {}
     return assignment_data.get("name", "Unnamed Assignment")
 
-def get_student_name(user_id):
-    endpoint = f"{CANVAS_API_URL}/users/{user_id}"
-    user_data = make_api_request(endpoint)
+async def get_user(user_id, account=None):
+    async def fetch():
+        endpoint = f"{CANVAS_API_URL}/users/{user_id}"
+        return await make_api_request(endpoint, account=account)
+
+    return await user_cache.get_or_fetch(user_id, fetch)
+
+async def get_student_name(user_id, account=None):
+    user_data = await get_user(user_id, account) or {}
     return user_data.get("name", "Unknown Student")
 
-def get_assignment_max_points(course_id, assignment_id):
-    endpoint = f"{CANVAS_API_URL}/courses/{course_id}/assignments/{assignment_id}"
-    assignment_data = make_api_request(endpoint)
+async def get_assignment_max_points(course_id, assignment_id, account=None):
+    assignment_data = await get_assignment(course_id, assignment_id, account) or {}
     return assignment_data.get("points_possible", 0)
 
-def fetch_submission_comments(course_id, assignment_id, user_id):
+async def fetch_submission_comments(course_id, assignment_id, user_id, account=None):
     endpoint = f"{CANVAS_API_URL}/courses/{course_id}/assignments/{assignment_id}/submissions/{user_id}"
-    submission = make_api_request(endpoint)
+    submission = await make_api_request(endpoint, account=account)
     return submission.get('submission_comments', []) if submission else []
\ No newline at end of file
@@ -0,0 +1,271 @@
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+
+from Cache import TTLCache
+from Metrics import course_label, endpoint_label, metrics
+
+
+# A page of a list endpoint that still failed after retries, so the items fetched so far are only part of the list
+class PageFetchError(Exception):
+    pass
+
+
+# Tracks Canvas's rate-limit bucket from response headers and paces requests before we get throttled
+class RequestGovernor:
+    def __init__(self, low_water=200, max_delay=2.0, stale_after=60):
+        # Below this many remaining units we start spacing requests out
+        self.low_water = low_water
+        self.max_delay = max_delay
+        # The bucket refills over time, so a reading this old (in seconds) no longer counts
+        self.stale_after = stale_after
+        self.remaining = None
+        self.last_cost = None
+        self.updated_at = None
+        self.throttled = 0
+        self.retries = 0
+        self._blocked_until = 0
+        # Earliest send time for the next request while the budget is low, shared by every caller
+        self._next_send = 0
+
+    def observe(self, headers):
+        remaining = headers.get("X-Rate-Limit-Remaining")
+        cost = headers.get("X-Request-Cost")
+        try:
+            if remaining is not None:
+                self.remaining = float(remaining)
+                self.updated_at = time.monotonic()
+            if cost is not None:
+                self.last_cost = float(cost)
+        except ValueError:
+            pass
+
+    def block_for(self, seconds):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def is_low(self):
+        if self.remaining is None or time.monotonic() - self.updated_at > self.stale_after:
+            return False
+        return self.remaining < self.low_water
+
+    def delay(self):
+        # Seconds to wait before this request. On a low budget each caller takes the next free slot, one spacing
+        # after the last one handed out, so concurrent requests go out spaced instead of all waking at once
+        now = time.monotonic()
+        send_at = self._blocked_until
+        if self.is_low():
+            self._next_send = max(now, self._next_send) + self.max_delay * (1 - self.remaining / self.low_water)
+            send_at = max(send_at, self._next_send)
+        return max(send_at - now, 0)
+
+    async def before_request(self):
+        wait = self.delay()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def report(self):
+        # The latest reading and any hold, plus the throttles and retries since the last report, for the governor
+        # of the same token in another process. Ages instead of monotonic times, those only compare within a process
+        now = time.monotonic()
+        report = {
+            "remaining": self.remaining,
+            "age": now - self.updated_at if self.updated_at is not None else None,
+            "last_cost": self.last_cost,
+            "blocked_for": max(self._blocked_until - now, 0),
+            "throttled": self.throttled,
+            "retries": self.retries,
+        }
+        self.throttled = 0
+        self.retries = 0
+        return report
+
+    def merge(self, report):
+        now = time.monotonic()
+        if report["remaining"] is not None:
+            updated_at = now - report["age"]
+            # Keep whichever reading is newer
+            if self.updated_at is None or updated_at >= self.updated_at:
+                self.remaining = report["remaining"]
+                self.updated_at = updated_at
+        if report["last_cost"] is not None:
+            self.last_cost = report["last_cost"]
+        if report["blocked_for"] > 0:
+            self.block_for(report["blocked_for"])
+        self.throttled += report["throttled"]
+        self.retries += report["retries"]
+
+    def state(self):
+        return {
+            "remaining": self.remaining,
+            "last_cost": self.last_cost,
+            "low": self.is_low(),
+            "throttled": self.throttled,
+            "retries": self.retries,
+        }
+
+
+# Async Canvas client, one pooled keep-alive session for the bot's lifetime
+class CanvasClient:
+    def __init__(self, token, connection_limit=10, timeout=30, max_retries=4, backoff_base=0.5,
+                 response_cache_size=1024):
+        self.token = token
+        self.connection_limit = connection_limit
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.governor = RequestGovernor()
+        # (url, params) -> (ETag, Last-Modified, parsed body, next page url) for conditional GETs
+        self.response_cache = TTLCache(maxsize=response_cache_size, ttl=86400)
+        self.not_modified = 0
+        self._session = None
+
+    def _get_session(self):
+        # The session has to be created inside the running event loop, so build it lazily
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+        return self._session
+
+    @staticmethod
+    def _cache_key(endpoint, params):
+        items = params.items() if isinstance(params, dict) else (params or ())
+        return endpoint, tuple(sorted((str(key), str(value)) for key, value in items))
+
+    def _validators(self, cached):
+        headers = {}
+        if cached is not None:
+            etag, last_modified = cached[0], cached[1]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def _record(self, endpoint, status, started, size=0, headers=None):
+        # Per endpoint and course, so we can see who is spending the rate-limit budget
+        labels = {"endpoint": endpoint_label(endpoint), "course": course_label(endpoint)}
+        metrics.inc("canvas_requests_total", status=str(status), **labels)
+        metrics.observe("canvas_request_seconds", time.monotonic() - started, **labels)
+        if size:
+            metrics.inc("canvas_response_bytes_total", size, **labels)
+        cost = (headers or {}).get("X-Request-Cost")
+        if cost:
+            try:
+                metrics.inc("canvas_request_cost_total", float(cost), **labels)
+            except ValueError:
+                pass
+
+    def _backoff(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, self.backoff_base * (2 ** attempt))
+
+    async def _fetch(self, endpoint, params=None):
+        # Returns (parsed body, next page url) or (None, None) on failure.
+        # Bodies served from the response cache are shared between callers, so don't mutate them.
+        session = self._get_session()
+        cache_key = self._cache_key(endpoint, params)
+        cached = self.response_cache.get(cache_key)
+        for attempt in range(self.max_retries + 1):
+            await self.governor.before_request()
+            started = time.monotonic()
+            try:
+                async with session.get(endpoint, params=params or {}, headers=self._validators(cached)) as response:
+                    self.governor.observe(response.headers)
+                    if response.status == 304 and cached is not None:
+                        # Nothing changed, skip the download and the JSON decode
+                        self.not_modified += 1
+                        self.response_cache.set(cache_key, cached)
+                        self._record(endpoint, 304, started, headers=response.headers)
+                        metrics.inc("canvas_cache_hits_total", endpoint=endpoint_label(endpoint))
+                        return cached[2], cached[3]
+
+                    if response.status == 200:
+                        body = await response.read()
+                        self._record(endpoint, 200, started, len(body), response.headers)
+                        data = json.loads(body)
+                        next_link = response.links.get("next")
+                        next_url = str(next_link["url"]) if next_link else None
+                        etag = response.headers.get("ETag")
+                        last_modified = response.headers.get("Last-Modified")
+                        if etag or last_modified:
+                            self.response_cache.set(cache_key, (etag, last_modified, data, next_url))
+                        return data, next_url
+
+                    self._record(endpoint, response.status, started, headers=response.headers)
+                    # Canvas throttles with a 403 "Rate Limit Exceeded", treat it like a 429
+                    throttled = response.status == 429 or (
+                        response.status == 403 and "rate limit" in (await response.text()).lower()
+                    )
+                    if throttled:
+                        self.governor.throttled += 1
+                        metrics.inc("canvas_throttled_total", endpoint=endpoint_label(endpoint))
+                    if not (throttled or response.status >= 500):
+                        print(f"Error fetching data from {endpoint}: {response.status}")
+                        return None, None
+                    error = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                self._record(endpoint, "error", started)
+                throttled = False
+                error = e
+
+            if attempt == self.max_retries:
+                break
+            wait = self._backoff(attempt)
+            if throttled:
+                # Hold every request, not just this one, while the bucket drains
+                self.governor.block_for(wait)
+            self.governor.retries += 1
+            metrics.inc("canvas_retries_total", endpoint=endpoint_label(endpoint))
+            print(f"Retrying {endpoint} in {wait:.1f}s after: {error}")
+            await asyncio.sleep(wait)
+
+        print(f"Error fetching data from {endpoint}: {error}")
+        return None, None
+
+    async def get(self, endpoint, params=None):
+        data, _ = await self._fetch(endpoint, params)
+        return data
+
+    async def paginate(self, endpoint, params=None, per_page=None):
+        """
+        Yields items from a Canvas list endpoint, following the rel="next" Link header.
+        Pages are only requested as the caller consumes items, so breaking out of the
+        loop stops fetching. Raises PageFetchError when a page fails after retries.
+        """
+        # Keep params as (key, value) pairs so repeated keys like include[] survive
+        params = list(params.items()) if isinstance(params, dict) else list(params or [])
+        if per_page:
+            params.append(("per_page", per_page))
+
+        url = endpoint
+        while url:
+            current = url
+            page, url = await self._fetch(url, params)
+            # The next link already carries the query string
+            params = None
+            if page is None:
+                raise PageFetchError(f"could not fetch {current}")
+            if not page:
+                return
+            if not isinstance(page, list):
+                yield page
+                return
+            for item in page:
+                yield item
+
+    def cache_stats(self):
+        stats = self.response_cache.stats()
+        stats["not_modified"] = self.not_modified
+        return stats
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
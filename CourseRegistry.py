@@ -0,0 +1,97 @@
+import json
+import time
+from os import stat
+
+
+# In-memory view of student_courses.json, indexed by id and by name.
+# With no path the list only comes from update(), e.g. for courses kept in the account store
+class CourseRegistry:
+    def __init__(self, path="student_courses.json", check_interval=30, courses=None):
+        self.path = path
+        # How often (in seconds) we're allowed to stat the file for outside changes
+        self.check_interval = check_interval
+        self.version = 0
+        self._courses = []
+        self._by_id = {}
+        self._by_name = {}
+        self._mtime = None
+        self._last_check = 0
+        self._loaded = False
+        if courses is not None:
+            self.update(courses)
+
+    def _index(self, courses):
+        self._courses = courses
+        self._by_id = {course["id"]: course for course in courses}
+        self._by_name = {}
+        for course in courses:
+            # Keep the first course for a duplicated name
+            self._by_name.setdefault(course["name"], course)
+        self.version += 1
+
+    def _load(self):
+        try:
+            mtime = stat(self.path).st_mtime
+            with open(self.path, "r") as file:
+                courses = json.load(file)
+        except FileNotFoundError:
+            print("No courses file found. Please fetch courses first.")
+            courses, mtime = [], None
+        except Exception as e:
+            print(f"Error reading courses file: {e}")
+            courses, mtime = [], None
+        self._mtime = mtime
+        self._loaded = True
+        self._index(courses)
+
+    def _refresh(self):
+        if self.path is None:
+            return
+        now = time.monotonic()
+        if self._loaded and now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if not self._loaded:
+            self._load()
+            return
+
+        # Reload only if someone else changed the file since we read it
+        try:
+            mtime = stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self._load()
+
+    def update(self, courses):
+        # Called after the courses file is rewritten so we don't have to read it back
+        self._index(courses)
+        try:
+            self._mtime = stat(self.path).st_mtime if self.path else None
+        except OSError:
+            self._mtime = None
+        self._loaded = True
+        self._last_check = time.monotonic()
+
+    def invalidate(self):
+        self._loaded = False
+
+    def courses(self):
+        self._refresh()
+        return self._courses
+
+    def ids(self):
+        return [course["id"] for course in self.courses()]
+
+    def names(self):
+        return [course["name"] for course in self.courses()]
+
+    def name_for(self, course_id):
+        self._refresh()
+        course = self._by_id.get(course_id)
+        return course["name"] if course else None
+
+    def id_for(self, course_name):
+        self._refresh()
+        course = self._by_name.get(course_name)
+        return course["id"] if course else None
@@ -0,0 +1,160 @@
+import asyncio
+import time
+
+import discord
+
+from Metrics import metrics
+
+# Discord limits for a single embed description and for all embeds on one message
+EMBED_DESCRIPTION_LIMIT = 4096
+MESSAGE_EMBED_LIMIT = 6000
+MESSAGE_MAX_EMBEDS = 10
+
+
+def split_text(text, limit):
+    # Split on line breaks where possible, hard-cutting any single line that is still too long
+    chunks = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_embeds(messages, color=None):
+    # Merge several notifications into as few embeds as the description limit allows
+    separator = "\n\n"
+    chunks = []
+    for message in messages:
+        for piece in split_text(message, EMBED_DESCRIPTION_LIMIT):
+            if chunks and len(chunks[-1]) + len(separator) + len(piece) <= EMBED_DESCRIPTION_LIMIT:
+                chunks[-1] += separator + piece
+            else:
+                chunks.append(piece)
+    return [discord.Embed(description=chunk, color=color or discord.Color.blue()) for chunk in chunks]
+
+
+def group_embeds(embeds):
+    # Pack embeds into messages under Discord's per-message embed count and size limits
+    groups = []
+    size = 0
+    for embed in embeds:
+        length = len(embed.description)
+        if not groups or len(groups[-1]) == MESSAGE_MAX_EMBEDS or size + length > MESSAGE_EMBED_LIMIT:
+            groups.append([])
+            size = 0
+        groups[-1].append(embed)
+        size += length
+    return groups
+
+
+# Per-recipient outbox, notifications that arrive within the coalesce window go out as one message
+class RecipientBucket:
+    def __init__(self, recipient):
+        self.recipient = recipient
+        self.messages = []
+        self.scheduled = False
+        self.last_sent = 0
+        # Keeps sends to one recipient in order even if two workers pick it up
+        self.lock = asyncio.Lock()
+
+
+# Outbound queue for DMs and channel posts, so polling never waits on Discord
+class DeliveryQueue:
+    def __init__(self, coalesce_window=5.0, workers=2, min_send_interval=1.0):
+        self.coalesce_window = coalesce_window
+        self.workers = workers
+        # Minimum gap between two sends to the same recipient
+        self.min_send_interval = min_send_interval
+        self.sent = 0
+        self.failed = 0
+        self._buckets = {}
+        self._ready = asyncio.Queue()
+        self._tasks = []
+
+    @staticmethod
+    def _key(recipient):
+        return type(recipient).__name__, recipient.id
+
+    def enqueue(self, recipient, message):
+        key = self._key(recipient)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = RecipientBucket(recipient)
+        bucket.messages.append((time.monotonic(), message))
+
+        # The first message opens the window, anything else inside it rides along
+        if not bucket.scheduled:
+            bucket.scheduled = True
+            asyncio.get_running_loop().call_later(self.coalesce_window, self._ready.put_nowait, key)
+
+    async def _send(self, bucket, messages):
+        kind = type(bucket.recipient).__name__
+        async with bucket.lock:
+            oldest = min(enqueued_at for enqueued_at, _ in messages)
+            for embeds in group_embeds(build_embeds([message for _, message in messages])):
+                try:
+                    await bucket.recipient.send(embeds=embeds)
+                    self.sent += 1
+                    metrics.inc("delivery_sends_total", recipient=kind)
+                except Exception as e:
+                    self.failed += 1
+                    metrics.inc("delivery_failures_total", recipient=kind)
+                    print(f"Could not send DM to {bucket.recipient}: {e}")
+            bucket.last_sent = time.monotonic()
+            metrics.inc("delivery_notifications_total", len(messages), recipient=kind)
+            # Time from the first notification being queued to it reaching Discord
+            metrics.observe("delivery_latency_seconds", bucket.last_sent - oldest, recipient=kind)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+
+            # Too soon after the last send to this recipient, come back later instead of holding a worker
+            wait = bucket.last_sent + self.min_send_interval - time.monotonic()
+            if wait > 0:
+                asyncio.get_running_loop().call_later(wait, self._ready.put_nowait, key)
+                continue
+
+            messages, bucket.messages = bucket.messages, []
+            bucket.scheduled = False
+            if messages:
+                await self._send(bucket, messages)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        # Send whatever is still waiting out its coalesce window
+        for bucket in self._buckets.values():
+            messages, bucket.messages = bucket.messages, []
+            if messages:
+                await self._send(bucket, messages)
+
+    def stats(self):
+        return {
+            "pending": sum(len(bucket.messages) for bucket in self._buckets.values()),
+            "sent": self.sent,
+            "failed": self.failed,
+        }
@@ -2,15 +2,23 @@ from os import getenv, listdir
 from dotenv import load_dotenv
 
 import discord
-from discord.ext import tasks, commands
-import requests
-from datetime import datetime
-import pytz
+from discord.ext import commands
+from datetime import timedelta
 
 from cogs.commands import Commands
+from Accounts import AccountStore
 import ApiUtil as au
-
-import re
+from Delivery import DeliveryQueue
+from HtmlRender import render_announcement
+from Metrics import metrics, start_metrics_server
+from PollWorkers import PollWorkerPool
+from PushReceiver import PushReceiver
+from PreferenceStore import CATEGORY_BITS, CHANNEL, MEMBER, PreferenceStore
+from Scheduler import PollScheduler
+from SeenStore import SeenStore
+import TimeUtil
+
+import asyncio
 
 # Load environment variables
 load_dotenv()
@@ -20,18 +28,45 @@ DISCORD_CHANNEL_ID = int(getenv("DISCORD_CHANNEL_ID", 0))
 DISCORD_SERVER_ID = int(getenv("DISCORD_SERVER_ID", 0))
 BOT_TOKEN = getenv('BOT_TOKEN')
 
+# Where grade polling starts for a course we have no high-water mark for yet
+DEFAULT_GRADED_SINCE = "2023-01-01T00:00:00Z"
+GRADED_SINCE_OVERLAP = timedelta(minutes=int(getenv("GRADED_SINCE_OVERLAP_MINUTES", 5)))
+# Inbox polling rechecks conversations active this long before the newest one it saw last time
+INBOX_SINCE_OVERLAP = timedelta(minutes=int(getenv("INBOX_SINCE_OVERLAP_MINUTES", 5)))
+# Announcement bodies are cut to this many characters, leaves room for the rest of the message in one embed
+ANNOUNCEMENT_TEXT_BUDGET = int(getenv("ANNOUNCEMENT_TEXT_BUDGET", 1500))
+
 # Set up the bot with intents
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
-# Initialize sets to track seen items
-seen_grades = set()
-seen_messages = set()
-seen_files = set()
-seen_announcements = set()
-bot.user_preferences = {}
+# Durable record of seen items, so restarts don't re-announce everything
+seen_store = SeenStore(
+    getenv("BOT_STATE_DB", "bot_state.db"),
+    retention_days=int(getenv("SEEN_RETENTION_DAYS", 180)),
+)
+# Files and announcements are per course, so they're tracked once for everybody
+seen_files = seen_store.category("files")
+seen_announcements = seen_store.category("announcements")
+# Canvas tokens members linked with !link_canvas, with their course lists, in the same state file
+account_store = AccountStore(getenv("BOT_STATE_DB", "bot_state.db"))
+au.load_accounts(account_store)
+bot.account_store = account_store
+# Member and channel notification preferences, loaded once here and written back in batches
+preferences = PreferenceStore(getenv("BOT_STATE_DB", "bot_state.db"))
+bot.preferences = preferences
+TimeUtil.user_timezones.update(preferences.timezones())
+# Local Prometheus-style /metrics endpoint, 0 turns it off
+METRICS_PORT = int(getenv("METRICS_PORT", 9108))
+metrics_runner = None
+# Outgoing notifications, merged per recipient over a short window
+delivery_queue = DeliveryQueue(
+    coalesce_window=float(getenv("DELIVERY_COALESCE_SECONDS", 5)),
+    workers=int(getenv("DELIVERY_WORKERS", 2)),
+    min_send_interval=float(getenv("DELIVERY_MIN_SEND_INTERVAL", 1)),
+)
 # Event: When the bot joins a new server
 @bot.event
 async def on_guild_join(guild):
@@ -51,233 +86,596 @@ async def on_guild_join(guild):
         await default_channel.send(help_message)
 
 # Canvas API Helper Functions
-def make_api_request(endpoint, params=None):
-    headers = {"Authorization": f"Bearer {CANVAS_API_TOKEN}"}
-    response = requests.get(endpoint, headers=headers, params=params or {})
-    if response.status_code == 200:
-        return response.json()
-    print(f"Error fetching data from {endpoint}: {response.status_code}")
-    return None
-
-def fetch_graded_assignments(course_id):
-    endpoint = f"{CANVAS_API_URL}/courses/{course_id}/students/submissions"
-    params = {"graded_since": "2023-01-01T00:00:00Z", "include[]": "submission_comments"}
-    return make_api_request(endpoint, params)
-
-def fetch_assignment_details(course_id, assignment_id):
-    endpoint = f"{CANVAS_API_URL}/courses/{course_id}/assignments/{assignment_id}"
-    return make_api_request(endpoint)
-
-def fetch_user_details(user_id):
-    endpoint = f"{CANVAS_API_URL}/users/{user_id}"
-    return make_api_request(endpoint)
-
-def fetch_inbox_messages():
+def graded_since_key(course_id, account):
+    # The bot's own account keeps the original key so existing marks carry over
+    if account.is_default:
+        return f"graded_since:{course_id}"
+    return f"graded_since:{account.owner_id}:{course_id}"
+
+async def fetch_graded_assignments(course_id, account=None):
+    # Only ask for submissions graded since the last one we saw for this course
+    account = account or au.default_account
+    watermark = graded_since_key(course_id, account)
+    graded_since = seen_store.get_watermark(watermark, DEFAULT_GRADED_SINCE)
+    # A failed page raises, so the mark below only ever moves after a complete fetch
+    submissions = await au.fetch_graded_submissions(course_id, graded_since, account)
+
+    # Move the mark up to the newest graded_at, less a small overlap for grades that land out of order
+    graded_times = [submission["graded_at"] for submission in submissions if submission.get("graded_at")]
+    if graded_times:
+        newest = max(filter(None, map(TimeUtil.parse_canvas_time, graded_times)), default=None)
+        if newest is not None:
+            seen_store.set_watermark(watermark, TimeUtil.format_canvas_time(newest - GRADED_SINCE_OVERLAP))
+    return submissions
+
+def fetch_inbox_messages(account=None):
+    # Most recently active conversations first, iterate and stop once they're older than the last poll
     endpoint = f"{CANVAS_API_URL}/conversations"
-    return make_api_request(endpoint)
+    return au.paginate_api_request(endpoint, account=account)
 
-def fetch_course_files(course_id):
+def fetch_course_files(course_id, account=None):
+    # Newest files first, iterate and stop once we reach one we've seen
     endpoint = f"{CANVAS_API_URL}/courses/{course_id}/files"
     params = {"sort": "created_at", "order": "desc"}
-    return make_api_request(endpoint, params)
-def fetch_announcements(course_id):
+    return au.paginate_api_request(endpoint, params, account=account)
+async def fetch_announcements(course_id, account=None):
     endpoint = f"{CANVAS_API_URL}/announcements"
     params = {"context_codes[]": f"course_{course_id}", "per_page": 5}
-    return make_api_request(endpoint, params)
-def clean_html(raw_html):
-    """Remove HTML tags from a string."""
-    clean_text = re.sub(r"<.*?>", "", raw_html)
-    return clean_text
+    return await au.make_api_request(endpoint, params, account)
 def format_posted_time(posted_at):
-    user_timezone = pytz.timezone("US/Pacific")
-    dt = datetime.strptime(posted_at, "%Y-%m-%dT%H:%M:%SZ")
-    due_date_utc = pytz.utc.localize(dt)
-    due_date_local = due_date_utc.astimezone(user_timezone)
-    return due_date_local.strftime("%m/%d/%Y at %I:%M %p")
-# Tasks for notifications
-@tasks.loop(minutes=1)
-async def announce_grades():
-
-    print("Checking for new grades!")
-    # Notify users based on preferences
-    guild = bot.get_guild(DISCORD_SERVER_ID)
+    # Notifications are built once for every subscriber, so they use the bot's default timezone
+    return TimeUtil.format_local(posted_at, TimeUtil.POSTED_FORMAT)
+def get_subscribers(guild, category, skip_linked=False):
+    # Members and channels that opted in to a notification category, optionally leaving out members with a linked token
+    bit = CATEGORY_BITS[category]
+    subscribers = []
     if guild:
-        for member in guild.members:
-            #print(member)
-            if member.bot:
+        for member_id in preferences.subscribers(MEMBER, bit):
+            if skip_linked and member_id in au.accounts:
                 continue
+            member = guild.get_member(member_id)
+            if member and not member.bot:
+                subscribers.append(member)
+    for channel_id in preferences.subscribers(CHANNEL, bit):
+        channel = bot.get_channel(channel_id)
+        if channel:
+            subscribers.append(channel)
+    return subscribers
+
+# Categories that carry one account's own data, members who linked a token only get these from their own account
+PRIVATE_CATEGORIES = ("Grades", "Messages")
+
+def get_account_recipients(guild, category, account):
+    # The bot's own account notifies every subscriber, a linked account only the member who linked it
+    if account.is_default:
+        return get_subscribers(guild, category, skip_linked=category in PRIVATE_CATEGORIES)
+    member = guild.get_member(account.owner_id) if guild else None
+    if member and not member.bot and preferences.is_subscribed(MEMBER, member.id, CATEGORY_BITS[category]):
+        return [member]
+    return []
+
+def get_course_recipients(guild, category, course_id):
+    # Subscribers for a course's shared files and announcements, over every account enrolled in it
+    recipients = []
+    added = set()
+    for account in au.accounts_for_course(course_id):
+        for recipient in get_account_recipients(guild, category, account):
+            if recipient.id not in added:
+                added.add(recipient.id)
+                recipients.append(recipient)
+    return recipients
+
+def course_account(course_id):
+    # Shared course resources are fetched once, with the bot's own token when it's enrolled
+    enrolled = au.accounts_for_course(course_id)
+    return enrolled[0] if enrolled else au.default_account
+
+async def dispatch(members, messages):
+    # Hand every collected message to the delivery queue for every subscriber, sending happens in the background
+    for member in members:
+        for message in messages:
+            delivery_queue.enqueue(member, message)
+
+async def build_grade_message(course_id, submission, account=None):
+    # Same side-loaded path as the recent grades view
+    record = await au.build_grade_record(course_id, submission, account)
+    grade = record["grade"] or "No Grade"
+    max_points = record["max_points"]
+    formatted_grade = f"{grade}/{max_points}" if max_points else grade
+
+    # Format the comments
+    formatted_comments = "\n".join(
+        f"- {comment['author_name']} at {format_posted_time(comment['created_at'])}: {comment['comment']}"
+        for comment in record["comments"]
+    ) or "No comments"
+
+    return (
+        f"📢 **New Grade Posted!**\n"
+        f"**Assignment:** {record['assignment_name']}\n"
+        f"**Student:** {record['student_name']}\n"
+        f"**Grade:** {formatted_grade}\n"
+        f"**Comments:**\n{formatted_comments}\n"
+        f"**Link:**\n{record['link']}\n"
+    )
 
-            # Check user for grade notifications
-            user_preferences = bot.user_preferences.get(member.id, [])
-            
-            for course_id in au.get_course_ids():
-                submissions = fetch_graded_assignments(course_id)
-                
-                if not submissions:
-                    continue
-
-                for submission in submissions:
-                    if submission['id'] not in seen_grades and submission.get('grade'):
-                        seen_grades.add(submission['id'])
-                        if "Grades" in user_preferences:
-                            # Get assignment details
-                            assignment_id = submission.get("assignment_id")
-                            assignment_name = au.get_assignment_name(course_id, assignment_id)
-                            user_id = submission.get("user_id")
-                            student_name = au.get_student_name(user_id)
-                            grade = submission.get('grade', "No Grade")
-                            max_points = au.get_assignment_max_points(course_id, assignment_id)
-                            formatted_grade = f"{grade}/{max_points}" if max_points else grade
-                            comments = submission.get('submission_comments', [])
-
-                            # Fetch comments if not included
-                            if not comments:
-                                comments = au.fetch_submission_comments(course_id, assignment_id, user_id)
-
-                            # Format the comments
-                            formatted_comments = "\n".join(
-                                f"- {comment['author_name']} at {format_posted_time(comment['created_at'])}: {comment['comment']}"
-                                for comment in comments
-                            ) or "No comments"
-
-                            link = submission.get("preview_url", "")
-
-                            try:
-                                # Send a DM to the user
-                                await member.send(
-                                    f"📢 **New Grade Posted!**\n"
-                                    f"**Assignment:** {assignment_name}\n"
-                                    f"**Student:** {student_name}\n"
-                                    f"**Grade:** {formatted_grade}\n"
-                                    f"**Comments:**\n{formatted_comments}\n"
-                                    f"**Link:**\n{link}\n"
-                                    )
-                            except Exception as e:
-                                print(f"Could not send DM to {member}: {e}")
-
-@tasks.loop(minutes=1)
-async def notify_inbox_messages():
-    
-    print("Checking for new messages!")
-    # Notify users based on their preferences
+def build_inbox_message(message):
+    # Extract message details
+    sender_name = message.get('participants', [{}])[0].get('name', "Unknown Sender")
+    subject = message.get('subject', "No Subject")
+    body = message.get('last_message', "No Content")
+
+    return (
+        f"📧 **New Canvas Inbox Message!**\n"
+        f"**From:** {sender_name}\n"
+        f"**Subject:** {subject}\n"
+        f"**Message:** {body}"
+    )
+
+def build_file_message(file):
+    # Extract file details
+    file_name = file.get("display_name", "Unknown File")
+    file_url = file.get("url", "No URL")
+    upload_time = format_posted_time(file.get("created_at", "Unknown Time"))
+
+    return (
+        f"📂 **New File Uploaded!**\n"
+        f"**File Name:** {file_name}\n"
+        f"**Uploaded At:** {upload_time}\n"
+        f"**Download Link:** [Click here]({file_url})"
+    )
+
+def build_announcement_message(course_name, announcement):
+    # Extract announcement details
+    title = announcement.get("title", "No Title")
+    raw_message = announcement.get("message", "No Content")
+    message = render_announcement(announcement.get("id"), raw_message, ANNOUNCEMENT_TEXT_BUDGET)
+    posted_at = announcement.get("posted_at", "Unknown Time")
+    formatted_time = format_posted_time(posted_at)
+
+    return (
+        f"📢 **New Announcement from {course_name}!**\n"
+        f"**Title:** {title}\n"
+        f"**Message:** {message}\n"
+        f"**Posted At:** {formatted_time}"
+    )
+
+# Collectors, each fetches from Canvas once per poll no matter how many members are subscribed
+async def collect_new_grades(course_id, build=True, submissions=None, account=None):
+    # Returns the messages and whether any new grades were seen, even when none were built
+    account = account or au.default_account
+    messages = []
+    seen_grades = seen_store.category("grades", account.owner_id)
+    # Pushed events bring their submissions with them, polling fetches them
+    if submissions is None:
+        submissions = await fetch_graded_assignments(course_id, account)
+        # The first pass for an account and course only records the grades that are already there
+        build = build and seen_store.is_primed("grades", account.owner_id, course_id)
+        seen_store.mark_primed("grades", account.owner_id, course_id)
+    elif not seen_store.is_primed("grades", account.owner_id, course_id):
+        # A push beat the course's first poll. Run that silent first pass now, leaving out the pushed grades,
+        # so the watermark moves and the next poll doesn't take every older grade for new
+        pushed = {submission['id'] for submission in submissions}
+        for submission in await fetch_graded_assignments(course_id, account):
+            if submission['id'] not in pushed and submission.get('grade'):
+                seen_grades.add(submission['id'])
+        seen_store.mark_primed("grades", account.owner_id, course_id)
+    if not submissions:
+        return messages, False
+
+    new_submissions = [
+        submission for submission in submissions
+        if submission['id'] not in seen_grades and submission.get('grade')
+    ]
+    for submission in new_submissions:
+        seen_grades.add(submission['id'])
+        if build:
+            messages.append(await build_grade_message(course_id, submission, account))
+    return messages, bool(new_submissions)
+
+async def collect_new_inbox_messages(build=True, account=None):
+    account = account or au.default_account
+    # Conversations are shared between participants, so each account tracks its own
+    seen_messages = seen_store.category("messages", account.owner_id)
+    build = build and seen_store.is_primed("messages", account.owner_id)
+    watermark = f"inbox_since:{account.owner_id}"
+    since = TimeUtil.parse_canvas_time(seen_store.get_watermark(watermark))
+    newest = None
+    messages = []
+    new_ids = []
+    # The inbox is sorted by last activity, so a reply lifts an old, seen conversation above newer unseen ones.
+    # Check every conversation active since the last poll instead of stopping at the first seen one
+    async for message in fetch_inbox_messages(account):
+        last_activity = TimeUtil.parse_canvas_time(message.get("last_message_at"))
+        if since and last_activity and last_activity < since - INBOX_SINCE_OVERLAP:
+            break
+        if last_activity and (newest is None or last_activity > newest):
+            newest = last_activity
+        if message['id'] in seen_messages:
+            continue
+        new_ids.append(message['id'])
+        if build:
+            messages.append(build_inbox_message(message))
+    # A failed page raises before anything is recorded, so the next poll sees the same conversations as new
+    for message_id in new_ids:
+        seen_messages.add(message_id)
+    if newest is not None:
+        seen_store.set_watermark(watermark, TimeUtil.format_canvas_time(newest))
+    seen_store.mark_primed("messages", account.owner_id)
+    return messages
+
+async def collect_new_files(course_id, account=None):
+    messages = []
+    new_ids = []
+    # The first pass for a course only records the files that are already there
+    build = seen_store.is_primed("files", part=course_id)
+    # Walk the course's files newest first, they're sorted by created_at so the first seen one ends the walk
+    async for file in fetch_course_files(course_id, account):
+        if file['id'] in seen_files:
+            break
+        new_ids.append(file['id'])
+        if build:
+            messages.append(build_file_message(file))
+    # Only recorded once the walk finished, a failed page raises and leaves them for the next poll
+    for file_id in new_ids:
+        seen_files.add(file_id)
+    seen_store.mark_primed("files", part=course_id)
+    return messages
+
+async def collect_new_announcements(course_id, build=True, announcements=None, account=None, course_name=None):
+    messages = []
+    # Fetch announcements for the course, unless they were pushed to us
+    if announcements is None:
+        announcements = await fetch_announcements(course_id, account)
+        if announcements is None:
+            return messages
+        build = build and seen_store.is_primed("announcements", part=course_id)
+        seen_store.mark_primed("announcements", part=course_id)
+    elif not seen_store.is_primed("announcements", part=course_id):
+        # A push beat the course's first poll, record the older announcements the poll would return first
+        latest = await fetch_announcements(course_id, account)
+        if latest is None:
+            return messages
+        pushed = {announcement['id'] for announcement in announcements}
+        for announcement in latest:
+            if announcement['id'] not in pushed:
+                seen_announcements.add(announcement['id'])
+        seen_store.mark_primed("announcements", part=course_id)
+
+    course_name = course_name or au.get_course_by_id(course_id)
+    for announcement in announcements:
+        if announcement['id'] not in seen_announcements:
+            seen_announcements.add(announcement['id'])
+            if build:
+                messages.append(build_announcement_message(course_name, announcement))
+    return messages
+
+async def collect_job(key, account, payload=None, build=True, course_name=None):
+    """
+    One poll job's new items as built messages, and whether new grades were seen.
+    `payload` holds pushed submissions or announcements.
+    """
+    owner_id, course_id, resource = key
+    grades_changed = False
+    if resource == "grades":
+        messages, grades_changed = await collect_new_grades(course_id, build=build, submissions=payload, account=account)
+    elif resource == "messages":
+        messages = await collect_new_inbox_messages(build=build, account=account)
+    elif resource == "files":
+        messages = await collect_new_files(course_id, account)
+    else:
+        messages = await collect_new_announcements(
+            course_id, build=build, announcements=payload, account=account, course_name=course_name
+        )
+    seen_store.flush()
+    return messages, grades_changed
+
+# Polling worker side, runs in each worker process. The gateway sends the token and the course name along with
+# the job, so accounts linked, relinked or given new courses after the workers started work without a restart
+async def run_worker_job(key, owner_id, token, payload=None, build=True, course_name=None):
+    account = await au.account_with_token(owner_id, token)
+    messages, grades_changed = await collect_job(key, account, payload, build, course_name)
+    # The gateway's governor decides when polling backs off and its registry serves !stats and /metrics, so hand
+    # back what the requests saw. A failed job sends nothing, the next one picks up what it left
+    return messages, grades_changed, (account.client.governor.report(), metrics.drain())
+
+async def close_worker():
+    await au.close_canvas_client()
+    seen_store.close()
+    preferences.close()
+    account_store.close()
+
+# Optional pool of polling worker processes, 0 keeps all polling on the bot's own event loop
+POLL_PROCESSES = int(getenv("POLL_PROCESSES", 0))
+poll_workers = PollWorkerPool(POLL_PROCESSES, run_worker_job, close_worker,
+                              timeout=int(getenv("POLL_WORKER_TIMEOUT", 300)))
+
+async def collect(key, account, payload=None, build=True):
+    # The seen ids for a job only live in the process that owns it, so with workers every collect goes through them
+    # Course names are resolved here, a worker doesn't see course lists that changed after it started
+    course_name = au.get_course_by_id(key[1]) if key[2] == "announcements" else None
+    if poll_workers.running:
+        messages, grades_changed, (governor, delta) = await poll_workers.run(
+            key, account.owner_id, account.client.token, payload, build, course_name
+        )
+        account.client.governor.merge(governor)
+        metrics.merge(delta)
+    else:
+        messages, grades_changed = await collect_job(key, account, payload, build, course_name)
+    if grades_changed:
+        # Current scores changed, so the cached GPA data is stale. The cache lives in this process, not the worker's
+        au.invalidate_current_grades(account)
+    return messages
+
+# Polling jobs, grades and the inbox per account, files and announcements per course. Each returns how many new events it found
+async def poll_course_grades(course_id, submissions=None, account=None):
+    account = account or au.default_account
     guild = bot.get_guild(DISCORD_SERVER_ID)
-    if guild:
-        for member in guild.members:
-            if member.bot:
-                continue
+    if not guild:
+        return 0
+    subscribers = get_account_recipients(guild, "Grades", account)
+    # Still mark grades as seen when nobody is subscribed, just skip building the messages
+    messages = await collect((account.owner_id, course_id, "grades"), account, submissions, build=bool(subscribers))
+    await dispatch(subscribers, messages)
+    return len(messages)
+
+async def poll_inbox_messages(account=None):
+    account = account or au.default_account
+    guild = bot.get_guild(DISCORD_SERVER_ID)
+    if not guild:
+        return 0
+    subscribers = get_account_recipients(guild, "Messages", account)
+    messages = await collect((account.owner_id, None, "messages"), account, build=bool(subscribers))
+    await dispatch(subscribers, messages)
+    return len(messages)
+
+async def poll_course_files(course_id):
+    messages = await collect((None, course_id, "files"), course_account(course_id))
+
+    # The configured channel always gets new files for the bot's own courses, plus anyone subscribed to them
+    recipients = get_course_recipients(bot.get_guild(DISCORD_SERVER_ID), "Files", course_id)
+    channel = bot.get_channel(DISCORD_CHANNEL_ID)
+    if channel and channel not in recipients and course_id in au.get_course_ids():
+        recipients.append(channel)
+    await dispatch(recipients, messages)
+    return len(messages)
+
+async def poll_course_announcements(course_id, announcements=None):
+    guild = bot.get_guild(DISCORD_SERVER_ID)
+    if not guild:
+        return 0
+    subscribers = get_course_recipients(guild, "Announcements", course_id)
+    messages = await collect(
+        (None, course_id, "announcements"), course_account(course_id), announcements, build=bool(subscribers)
+    )
+    await dispatch(subscribers, messages)
+    return len(messages)
 
-            # Get the users preferences
-            user_preferences = bot.user_preferences.get(member.id, [])
+# Shared per-course jobs, keyed (None, course_id, resource)
+COURSE_POLL_JOBS = {
+    "files": poll_course_files,
+    "announcements": poll_course_announcements,
+}
 
-            messages = fetch_inbox_messages()
-            if not messages:
-                continue
+# Full sweeps over every account and course, for running a check on demand outside the scheduler
+async def announce_grades():
+    print("Checking for new grades!")
+    for account in list(au.accounts.values()):
+        for course_id in au.get_course_ids(account):
+            await poll_course_grades(course_id, account=account)
 
-            for message in messages:
-                if message['id'] not in seen_messages:
-                    seen_messages.add(message['id'])
-                    # Check if the user wants inbox message notifications
-                    if "Messages" in user_preferences:
-
-                        # Extract message details
-                        sender_name = message.get('participants', [{}])[0].get('name', "Unknown Sender")
-                        subject = message.get('subject', "No Subject")
-                        body = message.get('last_message', "No Content")
-
-                        try:
-                            # Send a DM to the user
-                            await member.send(
-                                f"📧 **New Canvas Inbox Message!**\n"
-                                f"**From:** {sender_name}\n"
-                                f"**Subject:** {subject}\n"
-                                f"**Message:** {body}"
-                                )
-                        except Exception as e:
-                            print(f"Could not send DM to {member}: {e}")
-
-@tasks.loop(minutes=1)
-async def notify_new_files():
+async def notify_inbox_messages():
+    print("Checking for new messages!")
+    for account in list(au.accounts.values()):
+        await poll_inbox_messages(account)
+
+def all_course_ids():
+    course_ids = {}
+    for account in list(au.accounts.values()):
+        course_ids.update(dict.fromkeys(au.get_course_ids(account)))
+    return list(course_ids)
 
+async def notify_new_files():
     print("Checking for new files!")
-    course_ids = au.get_course_ids()
-    
-    for course_id in course_ids:
-        # Fetch the list of file objects for the current course
-        files = fetch_course_files(course_id)
-        
-        # Ensure non-empty list
-        if not files or not isinstance(files, list):
-            #print(f"No valid files found for course {course_id}. Response: {files}")
-            continue
+    for course_id in all_course_ids():
+        await poll_course_files(course_id)
 
-        for file in files:
-            if file['id'] not in seen_files:
-                seen_files.add(file['id'])
-
-                # Extract file details
-                file_name = file.get("display_name", "Unknown File")
-                file_url = file.get("url", "No URL")
-                upload_time = file.get("created_at", "Unknown Time")
-
-                channel = bot.get_channel(DISCORD_CHANNEL_ID)
-                if channel:
-                    await channel.send(
-                        f"📂 **New File Uploaded!**\n"
-                        f"**File Name:** {file_name}\n"
-                        f"**Uploaded At:** {upload_time}\n"
-                        f"**Download Link:** [Click here]({file_url})"
-                    ) 
-@tasks.loop(minutes=1)
 async def check_new_announcements():
-
     print("Checking for new announcements!")
-    # Notify users based on preferences
-    guild = bot.get_guild(DISCORD_SERVER_ID)  # Replace SERVER_ID with your server's ID
-    if guild:
-        for member in guild.members:
-            if member.bot:
-                continue
-                        
-            # Check if the user has opted in for announcements
-            user_preferences = bot.user_preferences.get(member.id, [])
-
-            course_ids = au.get_course_ids()  # Retrieve all course IDs
-            for course_id in course_ids:
-                course_name = au.get_course_by_id(course_id)
-                # Fetch announcements for the course
-                announcements = fetch_announcements(course_id)
-                if not announcements:
-                    continue
-
-                for announcement in announcements:
-                    if announcement['id'] not in seen_announcements:
-                        seen_announcements.add(announcement['id'])
-                        if "Announcements" in user_preferences:
-                            # Extract announcement details
-                            title = announcement.get("title", "No Title")
-                            raw_message = announcement.get("message", "No Content")
-                            message = clean_html(raw_message)
-                            posted_at = announcement.get("posted_at", "Unknown Time")
-                            formatted_time = format_posted_time(posted_at)
-                            try:
-                                await member.send(
-                                    f"📢 **New Announcement from {course_name}!**\n"
-                                    f"**Title:** {title}\n"
-                                    f"**Message:** {message}\n"
-                                    f"**Posted At:** {formatted_time}"
-                                    )
-                            except Exception as e:
-                                print(f"Could not send DM to {member}: {e}")                  
+    for course_id in all_course_ids():
+        await poll_course_announcements(course_id)
+
+POLL_MIN_INTERVAL = int(getenv("POLL_MIN_INTERVAL", 60))
+POLL_MAX_INTERVAL = int(getenv("POLL_MAX_INTERVAL", 900))
+
+def should_defer_job(job):
+    # Each account backs off on its own rate-limit budget, jobs without an account never make requests
+    if job.group is None:
+        return False
+    return au.rate_limit_is_low(au.get_account(job.group))
+
+# One scheduler owns all polling. Its workers are shared by every account, but no account gets more than
+# POLL_ACCOUNT_CONCURRENCY of them at once so one slow token can't hold up everybody else
+poll_scheduler = PollScheduler(
+    min_interval=POLL_MIN_INTERVAL,
+    max_interval=POLL_MAX_INTERVAL,
+    max_concurrent=int(getenv("POLL_WORKERS", 8)),
+    should_defer=should_defer_job,
+    group_limit=int(getenv("POLL_ACCOUNT_CONCURRENCY", 2)),
+)
+
+# Optional push ingestion, a local receiver for Canvas Live Events. 0 turns it off
+PUSH_PORT = int(getenv("PUSH_PORT", 0))
+# While push is healthy polling only runs as a slow reconciliation sweep
+PUSH_RECONCILE_MIN_INTERVAL = int(getenv("PUSH_RECONCILE_MIN_INTERVAL", 900))
+PUSH_RECONCILE_MAX_INTERVAL = int(getenv("PUSH_RECONCILE_MAX_INTERVAL", 3600))
+
+async def handle_push_event(event):
+    # Pushed grades and announcements go straight through the polling collectors, the rest trigger a poll
+    resource = event["resource"]
+    course_id = event["course_id"]
+    if resource == "messages":
+        for key in list(poll_scheduler.jobs):
+            if key[2] == "messages":
+                poll_scheduler.run_soon(key)
+        return 0
+    enrolled = au.accounts_for_course(course_id)
+    if not enrolled:
+        return 0
+    if resource == "grades":
+        # Grade jobs are per account, a hint without a usable submission polls each enrolled account's job
+        if not event["item_id"] or event["data"].get("grade") is None:
+            for account in enrolled:
+                poll_scheduler.run_soon((account.owner_id, course_id, "grades"))
+            return 0
+        # Only the account the submission belongs to announces it, the others aren't told about a classmate's grade
+        student_id = event["data"].get("user_id")
+        found = 0
+        for account in enrolled:
+            if student_id is None:
+                poll_scheduler.run_soon((account.owner_id, course_id, "grades"))
+            elif await au.get_canvas_user_id(account) == student_id:
+                found += await poll_course_grades(course_id, submissions=[event["data"]], account=account)
+        return found
+    if resource == "announcements" and event["item_id"]:
+        return await poll_course_announcements(course_id, announcements=[event["data"]])
+    poll_scheduler.run_soon((None, course_id, resource))
+    return 0
+
+async def check_push_health():
+    # Switch polling between the normal rate and slow reconciliation as push comes and goes
+    global push_active
+    healthy = push_receiver.healthy()
+    if healthy != push_active:
+        push_active = healthy
+        if healthy:
+            print("Push ingestion is healthy, polling only to reconcile")
+            poll_scheduler.set_intervals(PUSH_RECONCILE_MIN_INTERVAL, PUSH_RECONCILE_MAX_INTERVAL)
+        else:
+            print("Push ingestion went quiet, back to regular polling")
+            poll_scheduler.set_intervals(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL)
+    return 0
+
+push_receiver = PushReceiver(
+    handle_push_event,
+    secret=getenv("PUSH_SECRET"),
+    # Quiet for a few minimum poll intervals and regular polling takes back over
+    stale_after=int(getenv("PUSH_STALE_AFTER", 5 * POLL_MIN_INTERVAL)),
+)
+push_active = False
+
+# Let cogs reach the polling and delivery state, e.g. for !stats
+bot.poll_scheduler = poll_scheduler
+bot.delivery_queue = delivery_queue
+bot.push_receiver = push_receiver
+bot.poll_workers = poll_workers
+
+# Per-account jobs look their account up when they run, so a relinked token is used from the next poll on
+async def poll_account_grades(owner_id, course_id):
+    account = au.get_account(owner_id)
+    return await poll_course_grades(course_id, account=account) if account else 0
+
+async def poll_account_inbox(owner_id):
+    account = au.get_account(owner_id)
+    return await poll_inbox_messages(account) if account else 0
+
+async def sync_poll_jobs():
+    # Keep the jobs in line with the linked accounts and their course lists.
+    # Keys are (owner id, course id, resource), owner id is None for shared course jobs
+    wanted = {}
+    for account in list(au.accounts.values()):
+        owner_id = account.owner_id
+        wanted[(owner_id, None, "messages")] = (
+            lambda owner_id=owner_id: poll_account_inbox(owner_id), owner_id,
+            {"account": owner_id, "course": "", "resource": "messages"},
+        )
+        for course_id in au.get_course_ids(account):
+            wanted[(owner_id, course_id, "grades")] = (
+                lambda owner_id=owner_id, course_id=course_id: poll_account_grades(owner_id, course_id), owner_id,
+                {"account": owner_id, "course": course_id, "resource": "grades"},
+            )
+            for resource, poll in COURSE_POLL_JOBS.items():
+                # The first account enrolled in a course fetches its shared resources
+                wanted.setdefault((None, course_id, resource), (
+                    lambda course_id=course_id, poll=poll: poll(course_id), owner_id,
+                    {"account": "", "course": course_id, "resource": resource},
+                ))
+
+    for key in list(poll_scheduler.jobs):
+        if key[2] in ("messages", "grades", *COURSE_POLL_JOBS) and key not in wanted:
+            poll_scheduler.remove_job(key)
+    for key, (run, group, labels) in wanted.items():
+        poll_scheduler.add_job(key, run, labels=labels, group=group)
+    return 0
+
+def collect_gauges(registry):
+    # Point-in-time values refreshed whenever metrics are rendered
+    for account in list(au.accounts.values()):
+        rate_limit = au.get_rate_limit_state(account)
+        if rate_limit["remaining"] is not None:
+            registry.set("canvas_rate_limit_remaining", rate_limit["remaining"], account=account.owner_id)
+    registry.set("canvas_accounts", len(au.accounts))
+    for cache, stats in au.get_cache_stats().items():
+        registry.set("lookup_cache_hits", stats["hits"], cache=cache)
+        registry.set("lookup_cache_misses", stats["misses"], cache=cache)
+        registry.set("lookup_cache_size", stats["size"], cache=cache)
+    registry.set("delivery_pending", delivery_queue.stats()["pending"])
+    registry.set("poll_jobs", len(poll_scheduler.jobs))
+    registry.set("push_active", int(push_active))
+    if poll_workers.running:
+        registry.set("poll_workers_alive", poll_workers.stats()["alive"])
+
+metrics.add_collector(collect_gauges)
+
+def start_polling():
+    # Picks up linked accounts and course list changes, runs at a fixed rate
+    poll_scheduler.add_job((None, None, "courses"), sync_poll_jobs, min_interval=60, max_interval=60,
+                           labels={"account": "", "course": "", "resource": "courses"})
+    if push_receiver.running:
+        poll_scheduler.add_job((None, None, "push"), check_push_health, min_interval=30, max_interval=30,
+                               labels={"account": "", "course": "", "resource": "push"})
+    poll_scheduler.start()
 
 # Event: Bot is ready
 @bot.event
 async def on_ready():
+    global metrics_runner
     print(f"Logged in as {bot.user}!")
     await bot.add_cog(Commands(bot))
-    announce_grades.start()
-    notify_inbox_messages.start()
-    notify_new_files.start()
-    check_new_announcements.start()
+    delivery_queue.start()
+    if METRICS_PORT and metrics_runner is None:
+        try:
+            metrics_runner = await start_metrics_server(port=METRICS_PORT)
+        except OSError as e:
+            print(f"Could not start metrics server: {e}")
+    if PUSH_PORT and not push_receiver.running:
+        try:
+            await push_receiver.start(getenv("PUSH_HOST", "127.0.0.1"), PUSH_PORT)
+        except OSError as e:
+            print(f"Could not start push receiver: {e}")
+    if poll_workers.processes and not poll_workers.running:
+        poll_workers.start()
+    if not poll_scheduler.running:
+        await sync_poll_jobs()
+        start_polling()
+
+async def main():
+    async with bot:
+        try:
+            await bot.start(BOT_TOKEN)
+        finally:
+            # Stop polling, release the pooled Canvas connections and write out pending seen ids on shutdown
+            await poll_scheduler.stop()
+            await poll_workers.stop()
+            await push_receiver.stop()
+            await delivery_queue.stop()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            await au.close_canvas_client()
+            seen_store.close()
+            preferences.close()
+            account_store.close()
 
 # Run the bot
-bot.run(BOT_TOKEN)
+if __name__ == "__main__":
+    asyncio.run(main())
+
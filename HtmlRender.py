@@ -0,0 +1,180 @@
+import re
+from html.parser import HTMLParser
+
+from Cache import TTLCache
+
+# Input is fed to the parser in slices this big, so we stop reading soon after the budget is hit
+FEED_CHUNK = 8192
+# Stop reading past this much input even if the output budget isn't used up (e.g. pasted tables or inline images)
+MAX_INPUT = 512 * 1024
+
+BLOCK_TAGS = {
+    "p", "div", "section", "article", "header", "footer", "blockquote", "table", "pre",
+    "h1", "h2", "h3", "h4", "h5", "h6", "ul", "ol",
+}
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+SKIP_TAGS = {"script", "style", "head", "title"}
+WHITESPACE = re.compile(r"\s+")
+
+
+class _BudgetReached(Exception):
+    pass
+
+
+# Single-pass HTML to Discord markdown, entities decoded, output capped at `budget` characters
+class MarkdownRenderer(HTMLParser):
+    def __init__(self, budget):
+        super().__init__(convert_charrefs=True)
+        self.budget = budget
+        self.parts = []
+        self.length = 0
+        self.truncated = False
+        self._newlines = 1  # Treat the start like a fresh line so leading whitespace is dropped
+        self._last = "\n"
+        self._skip = 0
+        self._lists = []
+        self._links = []
+        self._row_cells = 0
+
+    def _emit(self, text):
+        if not text:
+            return
+        remaining = self.budget - self.length
+        if len(text) > remaining:
+            text = text[:remaining]
+            self.truncated = True
+            if not text:
+                raise _BudgetReached
+        self.parts.append(text)
+        self.length += len(text)
+        stripped = text.rstrip("\n")
+        self._newlines = len(text) - len(stripped) if stripped else self._newlines + len(text)
+        self._last = text[-1]
+        if self.truncated:
+            raise _BudgetReached
+
+    def _break(self, count=1):
+        # Make sure the output ends with at least `count` newlines, without piling them up
+        if self.length and self._newlines < count:
+            self._emit("\n" * (count - self._newlines))
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+            return
+        attrs = dict(attrs)
+        if tag in ("ul", "ol"):
+            self._break(1 if self._lists else 2)
+            self._lists.append([tag, 0])
+        elif tag == "li":
+            self._break(1)
+            depth = max(len(self._lists), 1)
+            if self._lists and self._lists[-1][0] == "ol":
+                self._lists[-1][1] += 1
+                bullet = f"{self._lists[-1][1]}. "
+            else:
+                bullet = "- "
+            self._emit("  " * (depth - 1) + bullet)
+        elif tag in HEADING_TAGS:
+            self._break(2)
+            self._emit("**")
+        elif tag in BLOCK_TAGS:
+            self._break(2)
+        elif tag == "br":
+            self._emit("\n")
+        elif tag == "hr":
+            self._break(2)
+            self._emit("---")
+            self._break(2)
+        elif tag in ("b", "strong"):
+            self._emit("**")
+        elif tag in ("i", "em"):
+            self._emit("*")
+        elif tag == "code":
+            self._emit("`")
+        elif tag == "a":
+            href = attrs.get("href") or ""
+            self._links.append((href, self.length))
+            if href:
+                self._emit("[")
+        elif tag == "img":
+            alt = (attrs.get("alt") or "").strip()
+            if alt:
+                self._emit(f"[{alt}]")
+        elif tag == "tr":
+            self._break(1)
+            self._row_cells = 0
+        elif tag in ("td", "th"):
+            if self._row_cells:
+                self._emit(" | ")
+            self._row_cells += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+            return
+        if tag in ("ul", "ol"):
+            if self._lists:
+                self._lists.pop()
+            self._break(1 if self._lists else 2)
+        elif tag in HEADING_TAGS:
+            self._emit("**")
+            self._break(2)
+        elif tag in BLOCK_TAGS:
+            self._break(2)
+        elif tag in ("b", "strong"):
+            self._emit("**")
+        elif tag in ("i", "em"):
+            self._emit("*")
+        elif tag == "code":
+            self._emit("`")
+        elif tag == "a" and self._links:
+            href, _ = self._links.pop()
+            if href:
+                self._emit(f"]({href})")
+        elif tag == "tr":
+            self._break(1)
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        text = WHITESPACE.sub(" ", data)
+        # No leading space at the start of a line or right after another space
+        if self._last in (" ", "\n"):
+            text = text.lstrip(" ")
+        self._emit(text)
+
+    def text(self):
+        output = "".join(self.parts).strip()
+        output = re.sub(r"\n{3,}", "\n\n", output)
+        output = re.sub(r"\[\]\(([^)]*)\)", r"\1", output)  # Links with no text just show the url
+        return output + "…" if self.truncated else output
+
+
+def html_to_markdown(raw_html, budget=1500):
+    if not raw_html:
+        return ""
+    renderer = MarkdownRenderer(budget)
+    try:
+        for start in range(0, min(len(raw_html), MAX_INPUT), FEED_CHUNK):
+            renderer.feed(raw_html[start:start + FEED_CHUNK])
+        if len(raw_html) > MAX_INPUT:
+            renderer.truncated = True
+        else:
+            renderer.close()
+    except _BudgetReached:
+        pass
+    return renderer.text()
+
+
+# Rendered announcement bodies, so re-sends and digests don't parse the same HTML again
+render_cache = TTLCache(maxsize=512, ttl=6 * 3600)
+
+
+def render_announcement(announcement_id, raw_html, budget=1500):
+    key = (announcement_id, budget)
+    rendered = render_cache.get(key)
+    if rendered is None:
+        rendered = html_to_markdown(raw_html, budget)
+        render_cache.set(key, rendered)
+    return rendered
@@ -1,8 +1,41 @@
-import json
-
 import discord
 from discord.ui import View, Button, Select
 import ApiUtil as au
+from PreferenceStore import MEMBER, category_mask, category_names
+import TimeUtil
+
+# Discord allows at most 25 options in one select menu
+SELECT_OPTION_LIMIT = 25
+# Account owner id -> (registry, registry version, pages of class options)
+_course_option_snapshots = {}
+
+def course_option_pages(account=None):
+    """Class select options for an account, in pages of 25. Rebuilt only when the account's course list changes."""
+    account = account or au.default_account
+    registry = account.registry
+    courses = registry.courses()
+    snapshot = _course_option_snapshots.get(account.owner_id)
+    if snapshot is None or snapshot[0] is not registry or snapshot[1] != registry.version:
+        # The value carries the course id, so duplicate names still pick the right course
+        options = [discord.SelectOption(label=course["name"][:100], value=str(course["id"])) for course in courses]
+        pages = [options[start:start + SELECT_OPTION_LIMIT] for start in range(0, len(options), SELECT_OPTION_LIMIT)]
+        snapshot = (registry, registry.version, pages)
+        _course_option_snapshots[account.owner_id] = snapshot
+    return snapshot[2]
+
+def build_grade_view(bot, account, page=0):
+    # Class select for one page of classes, with paging buttons once there are more than fit in one menu
+    select = ClassSelectMenu(bot, account, page)
+    grade_view = View(timeout=None)
+    grade_view.add_item(select)
+    if select.page_count > 1:
+        grade_view.add_item(ClassPageButton(bot, select.page - 1, "Previous classes", disabled=select.page == 0))
+        grade_view.add_item(ClassPageButton(bot, select.page + 1, "More classes", disabled=select.page == select.page_count - 1))
+    grade_view.add_item(GetGPAButton(bot))
+    grade_view.add_item(GetRecentGrades(bot, select))
+    grade_view.add_item(BackToMenuButton(bot))
+    return grade_view
+
 # View for Main Menu
 class MainMenu(View):
     def __init__(self, bot):
@@ -33,56 +66,62 @@ class GradeButton(Button):
             color=discord.Color.blue(),
         )
 
-        # Create the Select menu with the list of classes
-        select = ClassSelectMenu(self.bot)
-
-        # Add the Select menu to the view
-        grade_view = View(timeout=None)
-        grade_view.add_item(select)
-        grade_view.add_item(GetGPAButton(self.bot))
-        grade_view.add_item(GetRecentGrades(self.bot, select))
-        grade_view.add_item(BackToMenuButton(self.bot))
+        # Create the Select menu with the list of classes, from the member's linked account if they have one
+        grade_view = build_grade_view(self.bot, au.account_for(interaction.user.id))
 
         await interaction.response.edit_message(embed=embed, view=grade_view)
 
 # Select Menu for Classes
 class ClassSelectMenu(Select):
-    def __init__(self, bot):
-        # Dynamically populate options based on stored courses
-        course_names = au.get_course_names()
-        options = [discord.SelectOption(label=course) for course in course_names]
+    def __init__(self, bot, account=None, page=0):
+        # Options come from the account's prebuilt snapshot, one page at a time
+        pages = course_option_pages(account)
+        self.page_count = len(pages)
+        self.page = min(max(page, 0), max(self.page_count - 1, 0))
+        options = list(pages[self.page]) if pages else [discord.SelectOption(label="No classes found", value="0")]
+        placeholder = "Choose a class..."
+        if self.page_count > 1:
+            placeholder = f"Choose a class... (page {self.page + 1} of {self.page_count})"
 
         super().__init__(
-            placeholder="Choose a class...",
+            placeholder=placeholder,
             min_values=1,
             max_values=1,
-            options=options
+            options=options,
+            disabled=not pages,
         )
         self.bot = bot
+        self.account = account
 
     async def callback(self, interaction: discord.Interaction):
-        # Get the selected class from the dropdown
-        selected_class = self.values[0]
-        course_ids = au.get_course_ids()
-        course_names = au.get_course_names()
-
-        # Match the selected course name to its ID
-        course_id = None
-        for idx, name in enumerate(course_names):
-            if name == selected_class:
-                course_id = course_ids[idx]
-                break
-
-        if course_id:
-            letter_grade, percent_grade = au.get_current_grade(course_id)
+        # The selected option's value is the course id
+        course_id = int(self.values[0])
+        selected_class = au.get_course_by_id(course_id, self.account)
+
+        current_grade = await au.get_current_grade(course_id, self.account) if course_id else None
+        if current_grade:
+            letter_grade, percent_grade = current_grade
             letter_grade_message = letter_grade if letter_grade else "No letter grade data available."
             percent_grade_message = percent_grade if percent_grade else "No percent grade data available."
             await interaction.response.send_message(
                 f"In your class {selected_class}, you have a {letter_grade_message}, with a grade of {percent_grade_message}%", ephemeral=True
             )
+        elif course_id:
+            await interaction.response.send_message(f"No grade data available for {selected_class}.", ephemeral=True)
         else:
             await interaction.response.send_message("Selected class not found.", ephemeral=True)
 
+# Previous / next page of classes, for members with more classes than fit in one select menu
+class ClassPageButton(Button):
+    def __init__(self, bot, page, label, disabled=False):
+        super().__init__(label=label, style=discord.ButtonStyle.secondary, disabled=disabled)
+        self.bot = bot
+        self.page = page
+
+    async def callback(self, interaction: discord.Interaction):
+        grade_view = build_grade_view(self.bot, au.account_for(interaction.user.id), self.page)
+        await interaction.response.edit_message(view=grade_view)
+
 # Get GPA Button
 class GetGPAButton(Button):
     def __init__(self, bot):
@@ -112,25 +151,17 @@ class GetRecentGrades(Button):
         try:
             await interaction.response.defer(ephemeral=True)  # Keeps the interaction alive
 
-            # Fetch selected course or all courses
-            selected_class = self.select_menu.values[0] if self.select_menu.values else None
-            course_ids = au.get_course_ids()
-            course_names = au.get_course_names()
+            # Fetch selected course or all courses, the selected value is the course id
+            selected_course = int(self.select_menu.values[0]) if self.select_menu.values else None
             recent_grades = []
+            tz = TimeUtil.timezone_for(interaction.user.id)
+            account = au.account_for(interaction.user.id)
 
-            if selected_class:
-                # Fetch course ID for selected class
-                course_id = None
-                for idx, name in enumerate(course_names):
-                    if name == selected_class:
-                        course_id = course_ids[idx]
-                        break
-                if course_id:
-                    recent_grades = au.fetch_recent_grades(course_id)
-            else:
-                # Fetch grades for all courses
-                for course_id in course_ids:
-                    recent_grades.extend(au.fetch_recent_grades(course_id))
+            # Fetch grades for the selected course or all courses at once, a course that fails is skipped
+            fetch = lambda course_id: au.fetch_recent_grades(course_id, tz, account)
+            course_ids = [selected_course] if selected_course else au.get_course_ids(account)
+            for course_grades in await au.gather_courses(course_ids, fetch):
+                recent_grades.extend(course_grades or [])
 
             if not recent_grades:
                 await interaction.followup.send(
@@ -236,30 +267,21 @@ class PreferencesDropdown(Select):
     async def callback(self, interaction: discord.Interaction):
         # Get user ID
         user_id = interaction.user.id
-
-        # Ensure the user has an entry in the preferences dictionary
-        if user_id not in self.bot.user_preferences:
-            self.bot.user_preferences[user_id] = []
-
-        # Get the user's current preferences
-        current_preferences = set(self.bot.user_preferences[user_id])
+        selected = category_mask(self.values)
 
         # Add or remove preferences based on the action
         if self.action == "add":
-            updated_preferences = current_preferences.union(set(self.values))
+            updated = self.bot.preferences.add(MEMBER, user_id, selected)
         elif self.action == "remove":
-            updated_preferences = current_preferences.difference(set(self.values))
+            updated = self.bot.preferences.remove(MEMBER, user_id, selected)
         else:
             await interaction.response.send_message(
                 "Invalid action! Please try again.", ephemeral=True
             )
             return
 
-        # Update the user's preferences
-        self.bot.user_preferences[user_id] = list(updated_preferences)
-
         # Format the updated preferences for response
-        updated_preferences_str = ", ".join(self.bot.user_preferences[user_id]) or "No preferences set."
+        updated_preferences_str = ", ".join(category_names(updated)) or "No preferences set."
         await interaction.response.send_message(
             f"Your preferences have been updated. Current preferences: {updated_preferences_str}",
             ephemeral=True,
@@ -273,7 +295,7 @@ class ViewPreferencesButton(Button):
 
     async def callback(self, interaction: discord.Interaction):
         user_id = interaction.user.id
-        preferences = self.bot.user_preferences.get(user_id, ["No preferences set."])
+        preferences = category_names(self.bot.preferences.get(MEMBER, user_id)) or ["No preferences set."]
         await interaction.response.send_message(
             f"Your current preferences are: {', '.join(preferences)}",
             ephemeral=True,
@@ -313,7 +335,7 @@ class ViewClassesButton(Button):
 
     async def callback(self, interaction: discord.Interaction):
         # Fetch the current classes
-        course_names = au.get_course_names()
+        course_names = au.get_course_names(au.account_for(interaction.user.id))
         if not course_names:
             await interaction.response.send_message(
                 "No classes found. Please make sure you have enrolled in courses and synced data.",
@@ -335,8 +357,10 @@ class UpdateClassesButton(Button):
         self.bot = bot
 
     async def callback(self, interaction: discord.Interaction):
-        au.fetch_student_courses()  # Stores student course info in a JSON (If not a prototype, would do in a DB)
-        await interaction.response.send_message(
+        # Refreshes the course list of the member's linked account, or the bot's own
+        await interaction.response.defer(ephemeral=True)  # Keeps the interaction alive
+        await au.fetch_student_courses(au.account_for(interaction.user.id))
+        await interaction.followup.send(
             f"Your classes have been updated!",
             ephemeral=True,
         )
@@ -350,26 +374,30 @@ class ViewUpcomingAssignmentsButton(Button):
     async def callback(self, interaction: discord.Interaction):
         # Fetch course IDs from locally saved courses
         # Fetch upcoming assignments within the next week
-        upcoming_assignments = au.fetch_upcoming_assignments(au.get_course_ids())
+        await interaction.response.defer(ephemeral=True)  # Keeps the interaction alive
+        account = au.account_for(interaction.user.id)
+        upcoming_assignments = await au.fetch_upcoming_assignments(
+            au.get_course_ids(account), TimeUtil.timezone_for(interaction.user.id), account
+        )
         if not upcoming_assignments:
-            await interaction.response.send_message(
+            await interaction.followup.send(
                 "No upcoming assignments due within the next week.",
                 ephemeral=True,
             )
             return
 
-        # Sort assignments by due date
+        # Sort assignments by due date, on the datetime rather than the formatted string
         upcoming_assignments.sort(
-            key=lambda x: x['due_date']
+            key=lambda x: x['due_at']
         )
 
         # Format the upcoming assignments for display
         assignments_list = "\n".join(
-            f"- {assignment['assignment']} (Due: {assignment['due_date']}) for Class: {au.get_course_by_id(assignment['course'])}, Link: {assignment['link']}"
+            f"- {assignment['assignment']} (Due: {assignment['due_date']}) for Class: {au.get_course_by_id(assignment['course'], account)}, Link: {assignment['link']}"
             for assignment in upcoming_assignments
         )
 
-        await interaction.response.send_message(
+        await interaction.followup.send(
             f"Here are your upcoming assignments due within the next week (sorted by due date):\n{assignments_list}",
             ephemeral=True,
         )
@@ -0,0 +1,165 @@
+import re
+from bisect import bisect_left
+
+from aiohttp import web
+
+# Default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+
+# Counters, gauges and histograms kept in memory and rendered in the Prometheus text format
+class MetricsRegistry:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        # Callables run at render time to refresh gauges from other components' state
+        self.collectors = []
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        index = bisect_left(histogram["buckets"], value)
+        if index < len(histogram["counts"]):
+            histogram["counts"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def drain(self):
+        # Counters and histograms recorded since the last drain, for another process to merge into its own registry
+        delta = {"counters": self.counters, "histograms": self.histograms}
+        self.counters = {}
+        self.histograms = {}
+        return delta
+
+    def merge(self, delta):
+        for key, value in delta["counters"].items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, other in delta["histograms"].items():
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": other["buckets"], "counts": [0] * len(other["buckets"]), "sum": 0.0, "count": 0
+                }
+            histogram["counts"] = [mine + theirs for mine, theirs in zip(histogram["counts"], other["counts"])]
+            histogram["sum"] += other["sum"]
+            histogram["count"] += other["count"]
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def total(self, name, **labels):
+        # Sum of a counter across every label set matching the given labels
+        wanted = set(labels.items())
+        return sum(value for (metric, key), value in self.counters.items() if metric == name and wanted <= set(key))
+
+    def by_label(self, name, label):
+        # Counter totals grouped by one label, e.g. requests per endpoint
+        totals = {}
+        for (metric, key), value in self.counters.items():
+            if metric == name:
+                group = dict(key).get(label)
+                totals[group] = totals.get(group, 0) + value
+        return totals
+
+    def histogram_summary(self, name, label):
+        # Mean and count per label value, for quick human-readable stats
+        summary = {}
+        for (metric, key), histogram in self.histograms.items():
+            if metric == name:
+                group = dict(key).get(label)
+                entry = summary.setdefault(group, {"sum": 0.0, "count": 0})
+                entry["sum"] += histogram["sum"]
+                entry["count"] += histogram["count"]
+        return summary
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name}{_label_text(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_label_text(labels + (('le', '+Inf'),))} {histogram['count']}")
+            lines.append(f"{name}_sum{_label_text(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_label_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry
+metrics = MetricsRegistry()
+
+_ID_SEGMENT = re.compile(r"/(\d+|self)(?=/|$)")
+_COURSE_ID = re.compile(r"/courses/(\d+)")
+
+
+def endpoint_label(url):
+    # Collapse ids so /courses/123/files and /courses/456/files count as one endpoint
+    path = str(url).split("?", 1)[0]
+    path = path.split("/api/v1", 1)[-1]
+    return _ID_SEGMENT.sub(lambda match: "/self" if match.group(1) == "self" else "/:id", path)
+
+
+def course_label(url):
+    match = _COURSE_ID.search(str(url))
+    return match.group(1) if match else ""
+
+
+async def start_metrics_server(host="127.0.0.1", port=9108):
+    # Serves the registry at /metrics for a local Prometheus scrape
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,190 @@
+import asyncio
+import bisect
+import hashlib
+import itertools
+import multiprocessing
+import signal
+import threading
+
+from Metrics import metrics
+
+
+def _hash(value):
+    # Stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def partition_key(key):
+    # Poll job keys are (owner id, course id, resource), every resource of one token and course goes to the same worker
+    owner_id, course_id, _ = key
+    return f"{owner_id}:{course_id}"
+
+
+# Consistent hash ring, changing the number of workers only moves the keys of the workers added or removed
+class HashRing:
+    def __init__(self, nodes, replicas=64):
+        self._ring = sorted((_hash(f"{node}:{replica}"), node) for node in nodes for replica in range(replicas))
+        self._hashes = [point for point, _ in self._ring]
+
+    def node_for(self, key):
+        if not self._ring:
+            return None
+        position = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[position][1]
+
+
+def _serve(run, close, index, commands, results):
+    # Worker process entry point. Ctrl-C goes to the whole process group, let the gateway decide when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve_async(run, close, index, commands, results))
+
+
+async def _serve_async(run, close, index, commands, results):
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def handle(request_id, args):
+        try:
+            results.put((request_id, await run(*args), None))
+        except Exception as e:
+            results.put((request_id, None, f"{type(e).__name__}: {e}"))
+
+    while True:
+        command = await loop.run_in_executor(None, commands.get)
+        if command is None:
+            break
+        request_id, args = command
+        task = asyncio.create_task(handle(request_id, args))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if close is not None:
+        await close()
+
+
+# Runs poll jobs in a pool of worker processes, so fetching, JSON parsing and message formatting use more than one core.
+# Each worker owns a fixed partition of the job keys and sends back compact results, the gateway process only delivers
+class PollWorkerPool:
+    def __init__(self, processes, run, close=None, replicas=64, timeout=300):
+        self.processes = processes
+        # Module-level coroutine functions, pickled by reference: run(key, *args) returns the job's records
+        # and close() runs once in each worker on shutdown
+        self.run_job = run
+        self.close_job = close
+        self.ring = HashRing(range(processes), replicas)
+        # A job that hasn't come back after this many seconds counts as failed
+        self.timeout = timeout
+        self.dispatched = [0] * processes
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = []
+        self._results = None
+        self._reader = None
+        self._loop = None
+        # request id -> (worker index, future)
+        self._pending = {}
+        self._ids = itertools.count()
+
+    @property
+    def running(self):
+        return bool(self._workers)
+
+    def worker_for(self, key):
+        return self.ring.node_for(partition_key(key))
+
+    def _spawn(self, index):
+        commands = self._context.Queue()
+        process = self._context.Process(
+            target=_serve,
+            args=(self.run_job, self.close_job, index, commands, self._results),
+            name=f"poll-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        return process, commands
+
+    def start(self):
+        if self.running or not self.processes:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._results = self._context.Queue()
+        self._workers = [self._spawn(index) for index in range(self.processes)]
+        # Results come back on one queue, a thread waits on it and hands them to the event loop
+        self._reader = threading.Thread(target=self._read_results, name="poll-worker-results", daemon=True)
+        self._reader.start()
+        print(f"Polling in {self.processes} worker processes")
+
+    def _read_results(self):
+        while True:
+            result = self._results.get()
+            if result is None:
+                return
+            self._loop.call_soon_threadsafe(self._resolve, *result)
+
+    def _resolve(self, request_id, records, error):
+        pending = self._pending.pop(request_id, None)
+        if pending is None or pending[1].done():
+            return
+        if error is not None:
+            pending[1].set_exception(RuntimeError(error))
+        else:
+            pending[1].set_result(records)
+
+    def _commands_for(self, index):
+        # Replace a worker that died, its in-flight jobs fail and get retried on their next run
+        process, commands = self._workers[index]
+        if process.is_alive():
+            return commands
+        print(f"Polling worker {index} exited with code {process.exitcode}, restarting it")
+        self.restarts += 1
+        for request_id, (worker, future) in list(self._pending.items()):
+            if worker == index:
+                del self._pending[request_id]
+                if not future.done():
+                    future.set_exception(RuntimeError(f"polling worker {index} exited"))
+        self._workers[index] = self._spawn(index)
+        return self._workers[index][1]
+
+    async def run(self, key, *args):
+        # Run one job on the worker that owns its key and wait for its records
+        index = self.worker_for(key)
+        commands = self._commands_for(index)
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[request_id] = (index, future)
+        commands.put((request_id, (key, *args)))
+        self.dispatched[index] += 1
+        metrics.inc("poll_worker_jobs_total", worker=index)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def stop(self):
+        if not self.running:
+            return
+        loop = asyncio.get_running_loop()
+        for _, commands in self._workers:
+            commands.put(None)
+        for process, _ in self._workers:
+            # Give each worker time to finish its jobs and flush its seen ids
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        await loop.run_in_executor(None, self._reader.join, 5)
+        for _, future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._workers = []
+
+    def stats(self):
+        return {
+            "processes": self.processes,
+            "alive": sum(process.is_alive() for process, _ in self._workers),
+            "jobs": list(self.dispatched),
+            "pending": len(self._pending),
+            "restarts": self.restarts,
+        }
@@ -0,0 +1,141 @@
+import asyncio
+import sqlite3
+
+# Notification categories as bits of one integer, so checking a subscription is a single AND
+GRADES = 1
+ANNOUNCEMENTS = 2
+MESSAGES = 4
+FILES = 8
+CATEGORY_BITS = {"Grades": GRADES, "Announcements": ANNOUNCEMENTS, "Messages": MESSAGES, "Files": FILES}
+
+# Preferences are kept for members (DMs) and for channels
+MEMBER = "member"
+CHANNEL = "channel"
+KINDS = (MEMBER, CHANNEL)
+
+
+def category_mask(names):
+    # "grades", "Grades" and "GRADES" all map to the same bit, unknown names are ignored
+    lookup = {name.lower(): bit for name, bit in CATEGORY_BITS.items()}
+    mask = 0
+    for name in names:
+        mask |= lookup.get(name.lower(), 0)
+    return mask
+
+
+def category_names(mask):
+    return [name for name, bit in CATEGORY_BITS.items() if mask & bit]
+
+
+# Notification preferences for members and channels, held in memory and written behind to SQLite
+class PreferenceStore:
+    def __init__(self, path="bot_state.db", flush_delay=2.0):
+        self.path = path
+        # Changes are batched and written this many seconds after the first one
+        self.flush_delay = flush_delay
+        self._pending = {}
+        self._flush_handle = None
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS preferences ("
+            "kind TEXT NOT NULL, target_id INTEGER NOT NULL, mask INTEGER NOT NULL DEFAULT 0, timezone TEXT, "
+            "PRIMARY KEY (kind, target_id))"
+        )
+        self.conn.commit()
+
+        # kind -> {id: mask}, and member id -> timezone name
+        self._masks = {kind: {} for kind in KINDS}
+        self._timezones = {}
+        self.load()
+
+    def load(self):
+        # One query for everything, the table is small and read on every poll
+        self._masks = {kind: {} for kind in KINDS}
+        self._timezones = {}
+        for kind, target_id, mask, timezone in self.conn.execute(
+            "SELECT kind, target_id, mask, timezone FROM preferences"
+        ):
+            if kind not in self._masks:
+                continue
+            if mask:
+                self._masks[kind][target_id] = mask
+            if timezone:
+                self._timezones[target_id] = timezone
+
+    def get(self, kind, target_id):
+        return self._masks[kind].get(target_id, 0)
+
+    def is_subscribed(self, kind, target_id, bit):
+        return bool(self._masks[kind].get(target_id, 0) & bit)
+
+    def subscribers(self, kind, bit):
+        return [target_id for target_id, mask in self._masks[kind].items() if mask & bit]
+
+    def set(self, kind, target_id, mask):
+        if mask:
+            self._masks[kind][target_id] = mask
+        else:
+            self._masks[kind].pop(target_id, None)
+        self._mark_dirty(kind, target_id)
+        return mask
+
+    def add(self, kind, target_id, mask):
+        return self.set(kind, target_id, self.get(kind, target_id) | mask)
+
+    def remove(self, kind, target_id, mask):
+        return self.set(kind, target_id, self.get(kind, target_id) & ~mask)
+
+    def get_timezone(self, user_id):
+        return self._timezones.get(user_id)
+
+    def set_timezone(self, user_id, name):
+        self._timezones[user_id] = name
+        self._mark_dirty(MEMBER, user_id)
+
+    def timezones(self):
+        return dict(self._timezones)
+
+    def _mark_dirty(self, kind, target_id):
+        self._pending[(kind, target_id)] = None
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Outside the event loop (scripts, startup) there's nothing to batch with
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+
+        upserts = []
+        deletes = []
+        for kind, target_id in self._pending:
+            mask = self._masks[kind].get(target_id, 0)
+            timezone = self._timezones.get(target_id) if kind == MEMBER else None
+            if mask or timezone:
+                upserts.append((kind, target_id, mask, timezone))
+            else:
+                deletes.append((kind, target_id))
+        with self.conn:
+            if upserts:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO preferences (kind, target_id, mask, timezone) VALUES (?, ?, ?, ?)",
+                    upserts,
+                )
+            if deletes:
+                self.conn.executemany("DELETE FROM preferences WHERE kind = ? AND target_id = ?", deletes)
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
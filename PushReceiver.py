@@ -0,0 +1,174 @@
+import asyncio
+import hmac
+import time
+
+from aiohttp import web
+
+from Metrics import metrics
+
+# Canvas Live Events names -> the notification resource they belong to
+EVENT_RESOURCES = {
+    "grade_change": "grades",
+    "submission_updated": "grades",
+    "discussion_topic_created": "announcements",
+    "attachment_created": "files",
+    "conversation_created": "messages",
+    "conversation_message_created": "messages",
+}
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _course_id(metadata, body):
+    for source in (metadata, body):
+        if source.get("context_type") == "Course" and _int(source.get("context_id")):
+            return _int(source.get("context_id"))
+    return _int(body.get("course_id"))
+
+
+def normalize_event(payload):
+    """
+    Turn one Live Events style payload ({"metadata": {...}, "body": {...}}) into
+    {"resource", "course_id", "item_id", "data"}, or None for events we don't notify about.
+    `data` is shaped like the matching Canvas REST object so the polling code can build messages from it.
+    """
+    if not isinstance(payload, dict):
+        return None
+    metadata = payload.get("metadata") or {}
+    body = payload.get("body") or {}
+    name = metadata.get("event_name") or payload.get("event_name")
+    resource = EVENT_RESOURCES.get(name)
+    if resource is None:
+        return None
+    course_id = _course_id(metadata, body)
+    event_time = metadata.get("event_time")
+
+    if resource == "grades":
+        if name == "submission_updated" and body.get("workflow_state") != "graded":
+            return None
+        item_id = _int(body.get("submission_id"))
+        data = {
+            "id": item_id,
+            "assignment_id": _int(body.get("assignment_id")),
+            "user_id": _int(body.get("user_id") or body.get("student_id")),
+            "grade": body.get("grade"),
+            "score": body.get("score"),
+            "graded_at": body.get("graded_at") or event_time,
+            "preview_url": body.get("preview_url", ""),
+        }
+    elif resource == "announcements":
+        if not body.get("is_announcement"):
+            return None
+        item_id = _int(body.get("discussion_topic_id"))
+        data = {
+            "id": item_id,
+            "title": body.get("title"),
+            "message": body.get("body"),
+            "posted_at": body.get("posted_at") or event_time,
+        }
+    elif resource == "files":
+        item_id = _int(body.get("attachment_id"))
+        data = {"id": item_id, "display_name": body.get("display_name"), "created_at": event_time}
+    else:
+        item_id = _int(body.get("message_id") or body.get("conversation_id"))
+        data = {"id": item_id, "conversation_id": _int(body.get("conversation_id"))}
+
+    return {"resource": resource, "course_id": course_id, "item_id": item_id, "data": data}
+
+
+# Small local HTTP endpoint that receives pushed Canvas events and hands them to the bot
+class PushReceiver:
+    def __init__(self, handle_event, secret=None, stale_after=300):
+        # Coroutine function called with every normalized event
+        self.handle_event = handle_event
+        # Optional shared secret, expected in the X-Push-Secret header
+        self.secret = secret
+        # Push counts as healthy while we've heard something (an event or a heartbeat) this recently
+        self.stale_after = stale_after
+        self.last_seen = None
+        self.received = 0
+        self.ignored = 0
+        self.failed = 0
+        self._runner = None
+        self._tasks = set()
+
+    @property
+    def running(self):
+        return self._runner is not None
+
+    def healthy(self):
+        return self.running and self.last_seen is not None and time.monotonic() - self.last_seen < self.stale_after
+
+    def _authorized(self, request):
+        if not self.secret:
+            return True
+        return hmac.compare_digest(request.headers.get("X-Push-Secret", ""), self.secret)
+
+    async def _process(self, event):
+        try:
+            await self.handle_event(event)
+        except Exception as e:
+            self.failed += 1
+            metrics.inc("push_events_total", resource=event["resource"], outcome="failed")
+            print(f"Failed to handle pushed {event['resource']} event {event['item_id']}: {e}")
+
+    async def events_handler(self, request):
+        if not self._authorized(request):
+            return web.Response(status=401)
+        try:
+            payload = await request.json()
+        except ValueError:
+            return web.json_response({"error": "invalid JSON"}, status=400)
+
+        # Accept a single event, a list of them, or {"events": [...]}
+        if isinstance(payload, dict) and isinstance(payload.get("events"), list):
+            payload = payload["events"]
+        payloads = payload if isinstance(payload, list) else [payload]
+
+        self.last_seen = time.monotonic()
+        accepted = 0
+        for item in payloads:
+            event = normalize_event(item)
+            if event is None:
+                self.ignored += 1
+                metrics.inc("push_events_total", resource="", outcome="ignored")
+                continue
+            accepted += 1
+            self.received += 1
+            metrics.inc("push_events_total", resource=event["resource"], outcome="accepted")
+            # Handle in the background so the sender gets its response straight away
+            task = asyncio.create_task(self._process(event))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return web.json_response({"accepted": accepted, "ignored": len(payloads) - accepted}, status=202)
+
+    async def heartbeat_handler(self, request):
+        # Lets a forwarder keep push marked healthy through quiet periods
+        if not self._authorized(request):
+            return web.Response(status=401)
+        self.last_seen = time.monotonic()
+        return web.json_response({"healthy": self.healthy()})
+
+    async def start(self, host="127.0.0.1", port=9109):
+        app = web.Application()
+        app.router.add_post("/events", self.events_handler)
+        app.router.add_post("/heartbeat", self.heartbeat_handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        print(f"Receiving pushed Canvas events at http://{host}:{port}/events")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {"healthy": self.healthy(), "received": self.received, "ignored": self.ignored, "failed": self.failed}
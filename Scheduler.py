@@ -0,0 +1,191 @@
+import asyncio
+import random
+import time
+
+from Metrics import metrics
+
+
+# One polling job, e.g. the grades for a single course
+class PollJob:
+    def __init__(self, key, run, min_interval, max_interval, labels=None, group=None):
+        self.key = key
+        # Jobs in the same group (e.g. one Canvas account) share a concurrency limit
+        self.group = group
+        # Metric labels for this job's timings
+        self.labels = labels or {"job": str(key)}
+        # Coroutine function returning how many new events it found
+        self.run = run
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # Jobs added with their own bounds keep them when the scheduler defaults change
+        self.fixed = False
+        self.interval = min_interval
+        self.next_run = 0
+        self.last_run = None
+        self.last_duration = None
+        self.lag = 0
+        self.runs = 0
+        self.events = 0
+        self.failures = 0
+        self.running = False
+
+    def stats(self):
+        return {
+            "key": self.key,
+            "interval": self.interval,
+            "next_run_in": max(self.next_run - time.monotonic(), 0),
+            "last_duration": self.last_duration,
+            "lag": self.lag,
+            "runs": self.runs,
+            "events": self.events,
+            "failures": self.failures,
+        }
+
+
+# Owns every polling job, staggers them with jitter and adapts each job's interval to how active it is
+class PollScheduler:
+    def __init__(self, min_interval=60, max_interval=900, backoff=1.5, jitter=0.2, max_concurrent=4,
+                 should_defer=None, group_limit=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # Idle jobs slow down by this factor per empty run, up to max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        # Optional callable taking a due job, when it returns True the job is pushed back instead of run
+        self.should_defer = should_defer
+        # Most jobs of one group running at once, so one slow account can't take every slot
+        self.group_limit = group_limit
+        self.jobs = {}
+        self._group_running = {}
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._wake = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self._running_jobs = set()
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def add_job(self, key, run, min_interval=None, max_interval=None, labels=None, group=None):
+        if key in self.jobs:
+            return self.jobs[key]
+        job = PollJob(key, run, min_interval or self.min_interval, max_interval or self.max_interval, labels, group)
+        job.fixed = min_interval is not None or max_interval is not None
+        # Spread first runs across one interval so jobs don't all fire together
+        job.next_run = time.monotonic() + random.uniform(0, job.min_interval)
+        self.jobs[key] = job
+        self._wake.set()
+        return job
+
+    def remove_job(self, key):
+        self.jobs.pop(key, None)
+
+    def set_intervals(self, min_interval, max_interval):
+        # Change the interval bounds of every job using the defaults, e.g. when push ingestion takes over
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        for job in self.jobs.values():
+            if job.fixed:
+                continue
+            job.min_interval = min_interval
+            job.max_interval = max_interval
+            job.interval = min(max(job.interval, min_interval), max_interval)
+            job.next_run = min(job.next_run, time.monotonic() + self._jittered(job.interval))
+        self._wake.set()
+
+    def run_soon(self, key):
+        # Poll a job right away, e.g. after a hint that its resource changed
+        job = self.jobs.get(key)
+        if job is not None:
+            job.next_run = time.monotonic()
+            self._wake.set()
+
+    async def _run_job(self, job):
+        try:
+            async with self._semaphore:
+                started = time.monotonic()
+                job.lag = max(started - job.next_run, 0)
+                found = 0
+                try:
+                    found = await job.run() or 0
+                except Exception as e:
+                    job.failures += 1
+                    metrics.inc("poll_failures_total", **job.labels)
+                    print(f"Polling job {job.key} failed: {e}")
+                finished = time.monotonic()
+
+                metrics.observe("poll_tick_seconds", finished - started, **job.labels)
+                metrics.observe("poll_lag_seconds", job.lag, **job.labels)
+                metrics.inc("poll_runs_total", **job.labels)
+                if found:
+                    metrics.inc("poll_events_total", found, **job.labels)
+
+                job.runs += 1
+                job.events += found
+                job.last_run = finished
+                job.last_duration = finished - started
+                # Active jobs go back to the fastest rate, idle ones back off
+                if found:
+                    job.interval = job.min_interval
+                else:
+                    job.interval = min(job.interval * self.backoff, job.max_interval)
+                job.next_run = finished + self._jittered(job.interval)
+        finally:
+            # Also runs when the job is cancelled, so its group slot is always given back
+            job.running = False
+            self._group_running[job.group] -= 1
+            self._wake.set()
+
+    async def _loop(self):
+        # wait_for can swallow a cancel that lands as the wake event fires, so also check a flag
+        while not self._stopping:
+            now = time.monotonic()
+            due = [job for job in self.jobs.values() if not job.running and job.next_run <= now]
+            if due and self.should_defer is not None:
+                # Back off due jobs whose rate-limit budget is low instead of running them
+                deferred = [job for job in due if self.should_defer(job)]
+                for job in deferred:
+                    job.next_run = now + self._jittered(job.min_interval)
+                due = [job for job in due if job.next_run <= now]
+
+            for job in sorted(due, key=lambda job: job.next_run):
+                running = self._group_running.get(job.group, 0)
+                if self.group_limit and job.group is not None and running >= self.group_limit:
+                    # Stays due, picked up when one of its group's jobs finishes
+                    continue
+                self._group_running[job.group] = running + 1
+                job.running = True
+                task = asyncio.create_task(self._run_job(job))
+                self._running_jobs.add(task)
+                task.add_done_callback(self._running_jobs.discard)
+
+            # Due jobs held back by their group limit wait for a wake instead of spinning
+            now = time.monotonic()
+            waiting = [job.next_run for job in self.jobs.values() if not job.running and job.next_run > now]
+            timeout = max(min(waiting) - now, 0) if waiting else None
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if not self.running:
+            self._stopping = False
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._task.cancel()
+            for task in list(self._running_jobs):
+                task.cancel()
+            await asyncio.gather(self._task, *self._running_jobs, return_exceptions=True)
+            self._task = None
+
+    def stats(self):
+        return [job.stats() for job in self.jobs.values()]
@@ -0,0 +1,169 @@
+import sqlite3
+import time
+
+CATEGORIES = ("grades", "messages", "files", "announcements")
+
+
+# Set-like view over one category of the store, so callers can keep using `in` and add()
+class SeenSet:
+    def __init__(self, store, category, scope=0):
+        self.store = store
+        self.category = category
+        self.scope = scope
+
+    def __contains__(self, item_id):
+        return self.store.contains(self.category, item_id, self.scope)
+
+    def __len__(self):
+        return len(self.store._seen[self.category].get(self.scope, ()))
+
+    def add(self, item_id):
+        self.store.add(self.category, item_id, self.scope)
+
+
+# Durable record of which Canvas items we've already notified about, backed by SQLite in WAL mode.
+# Ids are kept per scope: 0 for the bot's own account, the owner's Discord id for a linked account
+class SeenStore:
+    def __init__(self, path="bot_state.db", retention_days=180, flush_size=200):
+        self.path = path
+        self.retention = retention_days * 86400
+        self.flush_size = flush_size
+        self._pending = []
+        self._pending_watermarks = {}
+        self._last_prune = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for category in CATEGORIES:
+            self._migrate_scope(category)
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS seen_{category} ("
+                "scope INTEGER NOT NULL DEFAULT 0, item_id INTEGER NOT NULL, seen_at REAL NOT NULL, "
+                "PRIMARY KEY (scope, item_id))"
+            )
+        # Per-key high-water marks, e.g. the latest graded_at we've seen for a course
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+        # category -> scope -> {item id: time last seen}, only for items still inside the retention window
+        self._seen = {category: {} for category in CATEGORIES}
+        self.load()
+
+    def _migrate_scope(self, category):
+        # Tables from before linked accounts have no scope column, move their rows to scope 0
+        columns = [row[1] for row in self.conn.execute(f"PRAGMA table_info(seen_{category})")]
+        if not columns or "scope" in columns:
+            return
+        with self.conn:
+            self.conn.execute(f"ALTER TABLE seen_{category} RENAME TO seen_{category}_old")
+            self.conn.execute(
+                f"CREATE TABLE seen_{category} ("
+                "scope INTEGER NOT NULL DEFAULT 0, item_id INTEGER NOT NULL, seen_at REAL NOT NULL, "
+                "PRIMARY KEY (scope, item_id))"
+            )
+            self.conn.execute(
+                f"INSERT INTO seen_{category} (scope, item_id, seen_at) SELECT 0, item_id, seen_at FROM seen_{category}_old"
+            )
+            self.conn.execute(f"DROP TABLE seen_{category}_old")
+
+    def load(self):
+        cutoff = time.time() - self.retention
+        for category in CATEGORIES:
+            seen = {}
+            for scope, item_id, seen_at in self.conn.execute(
+                f"SELECT scope, item_id, seen_at FROM seen_{category} WHERE seen_at >= ?", (cutoff,)
+            ):
+                seen.setdefault(scope, {})[item_id] = seen_at
+            self._seen[category] = seen
+        self._watermarks = dict(self.conn.execute("SELECT key, value FROM watermarks"))
+        # State from before first passes were recorded: scopes that already have ids count as primed everywhere
+        self._legacy_primed = set()
+        if not any(key.startswith("primed:") for key in self._watermarks):
+            self._legacy_primed = {(category, scope) for category in CATEGORIES for scope in self._seen[category]}
+
+    def category(self, category, scope=0):
+        return SeenSet(self, category, scope)
+
+    def add(self, category, item_id, scope=0):
+        seen = self._seen[category].setdefault(scope, {})
+        if item_id in seen:
+            return
+        now = time.time()
+        seen[item_id] = now
+        self._pending.append((category, scope, item_id, now))
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def contains(self, category, item_id, scope=0):
+        # Canvas keeps returning old items (the latest announcements, the newest file), so an id that's checked
+        # again gets its time refreshed. Retention then only drops ids Canvas has stopped sending
+        seen = self._seen[category].get(scope)
+        if not seen or item_id not in seen:
+            return False
+        now = time.time()
+        if now - seen[item_id] > self.retention / 2:
+            seen[item_id] = now
+            self._pending.append((category, scope, item_id, now))
+        return True
+
+    def is_primed(self, category, scope=0, part=None):
+        # A scope (and course, for per-course polling) is primed once it finished one silent first pass.
+        # Until then there's nothing to compare against, so everything already in Canvas would look new
+        return (category, scope) in self._legacy_primed or f"primed:{category}:{scope}:{part}" in self._watermarks
+
+    def mark_primed(self, category, scope=0, part=None):
+        self.set_watermark(f"primed:{category}:{scope}:{part}", "1")
+
+    def get_watermark(self, key, default=None):
+        return self._watermarks.get(key, default)
+
+    def set_watermark(self, key, value):
+        # Marks only move forward, values must sort in time order (e.g. ISO-8601 UTC strings)
+        current = self._watermarks.get(key)
+        if current is not None and value <= current:
+            return
+        self._watermarks[key] = value
+        self._pending_watermarks[key] = value
+
+    def flush(self):
+        # Write buffered ids in one transaction
+        if self._pending:
+            with self.conn:
+                for category in CATEGORIES:
+                    rows = [(scope, item_id, seen_at) for cat, scope, item_id, seen_at in self._pending if cat == category]
+                    if rows:
+                        self.conn.executemany(
+                            f"INSERT OR REPLACE INTO seen_{category} (scope, item_id, seen_at) VALUES (?, ?, ?)", rows
+                        )
+            self._pending.clear()
+
+        if self._pending_watermarks:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO watermarks (key, value) VALUES (?, ?)",
+                    self._pending_watermarks.items(),
+                )
+            self._pending_watermarks.clear()
+
+        # Drop anything older than the retention window at most once an hour
+        if time.time() - self._last_prune > 3600:
+            self.prune()
+
+    def prune(self):
+        self._last_prune = time.time()
+        cutoff = self._last_prune - self.retention
+        with self.conn:
+            for category in CATEGORIES:
+                self.conn.execute(f"DELETE FROM seen_{category} WHERE seen_at < ?", (cutoff,))
+        for category, scopes in self._seen.items():
+            self._seen[category] = {
+                scope: {item_id: seen_at for item_id, seen_at in seen.items() if seen_at >= cutoff}
+                for scope, seen in scopes.items()
+            }
+
+    def close(self):
+        self.flush()
+        self.conn.close()
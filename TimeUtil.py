@@ -0,0 +1,101 @@
+from datetime import datetime, timezone
+from functools import lru_cache
+from os import getenv
+
+import pytz
+from dotenv import load_dotenv
+
+# Timestamp format Canvas uses for every date field and query parameter
+CANVAS_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+DISPLAY_FORMAT = "%B %d, %Y, %I:%M %p"
+POSTED_FORMAT = "%m/%d/%Y at %I:%M %p"
+
+# Imported ahead of the modules that load .env, so load it here too before reading the default
+load_dotenv()
+DEFAULT_TIMEZONE_NAME = getenv("USER_TIMEZONE", "America/Los_Angeles")
+
+
+@lru_cache(maxsize=None)
+def _load_timezone(name):
+    return pytz.timezone(name)
+
+
+def get_timezone(name=None):
+    # Timezones are resolved once per name, pytz.timezone() is slow to call per item
+    try:
+        return _load_timezone(name or DEFAULT_TIMEZONE_NAME)
+    except pytz.UnknownTimeZoneError:
+        print(f"Unknown timezone {name!r}, using {DEFAULT_TIMEZONE_NAME}")
+        return _load_timezone(DEFAULT_TIMEZONE_NAME)
+
+
+def is_valid_timezone(name):
+    try:
+        _load_timezone(name)
+        return True
+    except pytz.UnknownTimeZoneError:
+        return False
+
+
+# Per-user timezone overrides, user id -> timezone name
+user_timezones = {}
+
+
+def set_user_timezone(user_id, name):
+    if not is_valid_timezone(name):
+        return False
+    user_timezones[user_id] = name
+    return True
+
+
+def timezone_for(user_id=None):
+    return get_timezone(user_timezones.get(user_id))
+
+
+def now_utc():
+    return datetime.now(timezone.utc)
+
+
+def parse_canvas_time(value):
+    """Parse a Canvas ISO-8601 timestamp into an aware UTC datetime, None if it's missing or malformed."""
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value
+    try:
+        # fromisoformat is implemented in C, far cheaper than strptime
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def format_canvas_time(value):
+    return value.astimezone(timezone.utc).strftime(CANVAS_FORMAT)
+
+
+def to_local(value, tz=None):
+    parsed = parse_canvas_time(value)
+    if parsed is None:
+        return None
+    return parsed.astimezone(tz or get_timezone())
+
+
+def localize_all(values, tz=None):
+    # Batch version of to_local, the timezone is looked up once for the whole list
+    tz = tz or get_timezone()
+    local = []
+    for value in values:
+        parsed = parse_canvas_time(value)
+        local.append(parsed.astimezone(tz) if parsed is not None else None)
+    return local
+
+
+def format_local(value, fmt=DISPLAY_FORMAT, tz=None):
+    # Falls back to the raw value so "Unknown Time" and odd formats still show something
+    local = to_local(value, tz)
+    return local.strftime(fmt) if local is not None else value
@@ -0,0 +1,160 @@
+"""
+Polling-tick benchmark against a local mock Canvas and stubbed Discord objects.
+
+Runs each notification sweep and Menu aggregate a few times (the first run is the cold
+start, later ones are steady-state polls) and reports, per run:
+  - HTTP calls made to Canvas
+  - wall time
+  - event-loop blocking (longest stall and total stall time seen by a 5ms ticker)
+  - peak Python memory allocated during the run, above what was live when it started
+  - Discord sends made by the delivery queue (coalesced notifications)
+
+Usage (from the repo root):
+    python bench/bench_polling.py --courses 10 --submissions 100 --latency 0.05 --runs 3
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from mock_canvas import MockCanvas
+from stub_discord import StubChannel, StubGuild, attach, delivered
+
+
+class LoopMonitor:
+    # Measures how long the event loop goes without getting back to a short sleep
+    def __init__(self, interval=0.005, threshold=0.01):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_block = 0.0
+        self.total_block = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            overshoot = time.perf_counter() - start - self.interval
+            self.max_block = max(self.max_block, overshoot)
+            if overshoot > self.threshold:
+                self.total_block += overshoot
+
+    def start(self):
+        self.max_block = self.total_block = 0.0
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--courses", type=int, default=5)
+    parser.add_argument("--assignments", type=int, default=40)
+    parser.add_argument("--submissions", type=int, default=40)
+    parser.add_argument("--files", type=int, default=30)
+    parser.add_argument("--announcements", type=int, default=10)
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every Canvas response")
+    parser.add_argument("--per-page", type=int, default=10, help="mock Canvas page size when the client doesn't ask for one")
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--send-latency", type=float, default=0.0, help="seconds added to every Discord send")
+    parser.add_argument("--runs", type=int, default=2, help="runs per target, the first one is cold")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--cold-start", action="store_true", help="run the silent first pass of a fresh install")
+    return parser.parse_args()
+
+
+async def main(args):
+    canvas = MockCanvas(
+        courses=args.courses, assignments=args.assignments, submissions=args.submissions,
+        files=args.files, announcements=args.announcements, conversations=args.conversations,
+        latency=args.latency, per_page=args.per_page, port=args.port,
+    )
+
+    # The bot reads its config and state files at import time, so point them at a scratch directory first
+    workdir = tempfile.mkdtemp(prefix="canvas-bench-")
+    os.chdir(workdir)
+    os.environ["CANVAS_API_URL"] = canvas.base_url
+    os.environ["CANVAS_API_TOKEN"] = "bench-token"
+    os.environ["BOT_STATE_DB"] = os.path.join(workdir, "bot_state.db")
+    os.environ["DELIVERY_COALESCE_SECONDS"] = "0.05"
+    os.environ["DELIVERY_MIN_SEND_INTERVAL"] = "0"
+
+    import ApiUtil as au
+    import DiscordBot as db
+    from PreferenceStore import MEMBER, category_mask
+
+    guild = StubGuild(args.members, send_latency=args.send_latency)
+    channel = StubChannel(2, send_latency=args.send_latency)
+    attach(db.bot, guild, channel)
+    # Same as picking every option in the preferences dropdown, new files still only go to the channel
+    selected = category_mask(["Grades", "Announcements", "Messages"])
+    for member in guild.members[:args.subscribers]:
+        db.preferences.set(MEMBER, member.id, selected)
+
+    await canvas.start()
+    await au.fetch_student_courses()
+    db.delivery_queue.start()
+    if not args.cold_start:
+        # The bot's real first pass only records what's there, count every course as polled once
+        # so the first run still builds and delivers a full burst of notifications
+        for course_id in au.get_course_ids():
+            for category in ("grades", "files", "announcements"):
+                db.seen_store.mark_primed(category, 0, course_id)
+
+    async def recent_grades_all_courses():
+        return await au.gather_courses(au.get_course_ids(), au.fetch_recent_grades)
+
+    targets = [
+        ("announce_grades", db.announce_grades),
+        ("notify_new_files", db.notify_new_files),
+        ("check_new_announcements", db.check_new_announcements),
+        ("fetch_upcoming_assignments", lambda: au.fetch_upcoming_assignments(au.get_course_ids())),
+        ("calculate_gpa", au.calculate_gpa),
+        ("fetch_recent_grades", recent_grades_all_courses),
+    ]
+
+    monitor = LoopMonitor()
+    tracemalloc.start()
+    print(f"{'target':<28}{'run':>4}{'http':>7}{'wall ms':>10}{'max block ms':>14}"
+          f"{'blocked ms':>12}{'peak KiB':>10}{'sent':>7}")
+    for name, target in targets:
+        for run in range(1, args.runs + 1):
+            canvas.calls.clear()
+            sent_before = delivered(guild, channel)
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            monitor.start()
+
+            start = time.perf_counter()
+            await target()
+            wall = time.perf_counter() - start
+            # Let the delivery queue drain so sends are counted against this run
+            await asyncio.sleep(float(os.environ["DELIVERY_COALESCE_SECONDS"]) * 2 + args.send_latency * 4)
+
+            await monitor.stop()
+            _, peak = tracemalloc.get_traced_memory()
+            print(f"{name:<28}{run:>4}{sum(canvas.calls.values()):>7}{wall * 1000:>10.1f}"
+                  f"{monitor.max_block * 1000:>14.1f}{monitor.total_block * 1000:>12.1f}"
+                  f"{(peak - baseline) / 1024:>10.0f}{delivered(guild, channel) - sent_before:>7}")
+
+    tracemalloc.stop()
+    await db.delivery_queue.stop()
+    await au.close_canvas_client()
+    db.seen_store.close()
+    db.preferences.close()
+    db.account_store.close()
+    await canvas.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
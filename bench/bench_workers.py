@@ -0,0 +1,150 @@
+"""
+Polling worker scale-out benchmark against a local mock Canvas.
+
+Runs every poll job (grades and inbox per account, files and announcements per course)
+at once, like a busy scheduler tick, with polling on the bot's own event loop and with
+pools of worker processes. The mock Canvas runs in its own processes so it doesn't share
+a core with the bot. Reports, per pool size and run (the first run is the cold start):
+  - wall time for the whole tick
+  - CPU time used by the gateway process
+  - new events found, and jobs handled by each worker
+
+Usage (from the repo root):
+    python bench/bench_workers.py --processes 0,2,4 --courses 20 --accounts 4 --runs 3
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", default="0,2,4", help="comma separated pool sizes, 0 polls in-process")
+    parser.add_argument("--courses", type=int, default=20)
+    parser.add_argument("--submissions", type=int, default=60)
+    parser.add_argument("--files", type=int, default=30)
+    parser.add_argument("--announcements", type=int, default=10)
+    parser.add_argument("--accounts", type=int, default=4, help="linked accounts on top of the bot's own")
+    parser.add_argument("--concurrency", type=int, default=16, help="jobs in flight at once, like POLL_WORKERS")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to every Canvas response")
+    parser.add_argument("--mock-processes", type=int, default=2)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument("--port", type=int, default=8797)
+    parser.add_argument("--pool", type=int, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def serve_mock(args, ready):
+    # One mock Canvas process, several of them share the port
+    from aiohttp import web
+    from mock_canvas import MockCanvas
+
+    async def serve():
+        canvas = MockCanvas(courses=args.courses, submissions=args.submissions, files=args.files,
+                            announcements=args.announcements, latency=args.latency, port=args.port)
+        runner = web.AppRunner(canvas.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, canvas.host, canvas.port, reuse_port=True).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def run_pool(args):
+    # Child run for one pool size, the bot reads its config at import time so each size gets a fresh process
+    workdir = tempfile.mkdtemp(prefix="canvas-workers-")
+    os.chdir(workdir)
+    os.environ["CANVAS_API_URL"] = f"http://127.0.0.1:{args.port}/api/v1"
+    os.environ["CANVAS_API_TOKEN"] = "bench-token"
+    os.environ["BOT_STATE_DB"] = os.path.join(workdir, "bot_state.db")
+    os.environ["DELIVERY_COALESCE_SECONDS"] = "0.05"
+    os.environ["DELIVERY_MIN_SEND_INTERVAL"] = "0"
+    os.environ["POLL_PROCESSES"] = str(args.pool)
+
+    import ApiUtil as au
+    import DiscordBot as db
+    from PreferenceStore import CHANNEL, MEMBER, category_mask
+    from stub_discord import StubChannel, StubGuild, attach
+
+    guild = StubGuild(args.accounts + 10)
+    channel = StubChannel(2)
+    attach(db.bot, guild, channel)
+    for member in guild.members:
+        db.preferences.set(MEMBER, member.id, category_mask(["Grades", "Announcements", "Messages"]))
+    db.preferences.set(CHANNEL, channel.id, category_mask(["Files"]))
+
+    await au.fetch_student_courses()
+    for member in guild.members[:args.accounts]:
+        await au.link_account(member.id, f"bench-token-{member.id}", db.account_store)
+    await db.sync_poll_jobs()
+    jobs = list(db.poll_scheduler.jobs.values())
+    # Count every job as polled once so the first run builds every notification, not just the bot's silent
+    # first pass. Flushed before the workers start so they load it
+    for owner_id, course_id, resource in db.poll_scheduler.jobs:
+        db.seen_store.mark_primed(resource, owner_id or 0, course_id)
+    db.seen_store.flush()
+    db.delivery_queue.start()
+    db.poll_workers.start()
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_job(job):
+        async with semaphore:
+            return await job.run()
+
+    for run in range(1, args.runs + 1):
+        cpu = time.process_time()
+        start = time.perf_counter()
+        found = sum(await asyncio.gather(*(run_job(job) for job in jobs)))
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        per_worker = "/".join(str(count) for count in db.poll_workers.dispatched) or "-"
+        print(f"{args.pool:>9}{run:>4}{len(jobs):>6}{wall * 1000:>10.0f}{cpu * 1000:>13.0f}{found:>8}  {per_worker}",
+              flush=True)
+
+    await db.poll_workers.stop()
+    await db.delivery_queue.stop()
+    await au.close_canvas_client()
+    db.seen_store.close()
+    db.preferences.close()
+    db.account_store.close()
+
+
+def main(args):
+    context = multiprocessing.get_context("spawn")
+    mocks = []
+    for _ in range(args.mock_processes):
+        ready = context.Event()
+        process = context.Process(target=serve_mock, args=(args, ready), daemon=True)
+        process.start()
+        ready.wait(30)
+        mocks.append(process)
+
+    print(f"{'processes':>9}{'run':>4}{'jobs':>6}{'wall ms':>10}{'gateway cpu':>13}{'events':>8}  jobs per worker")
+    try:
+        for pool in [int(size) for size in args.processes.split(",")]:
+            command = [sys.executable, os.path.abspath(__file__), "--pool", str(pool)]
+            for name in ("courses", "submissions", "files", "announcements", "accounts", "concurrency",
+                         "latency", "runs", "port"):
+                command += [f"--{name}", str(getattr(args, name))]
+            subprocess.run(command, check=True)
+    finally:
+        for process in mocks:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.pool is None:
+        main(arguments)
+    else:
+        asyncio.run(run_pool(arguments))
@@ -0,0 +1,256 @@
+"""
+Local stand-in for the parts of the Canvas REST API the bot uses.
+
+Course, assignment, submission, file, announcement and conversation counts, response latency
+and page size are configurable. Responses are paginated with Link headers, carry ETags and
+rate-limit headers like Canvas does, and every request is counted per endpoint.
+"""
+import asyncio
+import hashlib
+import json
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+
+def iso(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class MockCanvas:
+    def __init__(self, courses=5, assignments=40, submissions=40, files=30, announcements=10,
+                 conversations=20, latency=0.02, per_page=10, host="127.0.0.1", port=8799):
+        self.latency = latency
+        self.default_per_page = per_page
+        self.host = host
+        self.port = port
+        self.calls = Counter()
+        self._runner = None
+        self._build_data(courses, assignments, submissions, files, announcements, conversations)
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/api/v1"
+
+    def _build_data(self, courses, assignments, submissions, files, announcements, conversations):
+        now = datetime.now(timezone.utc)
+        self.user = {"id": 1, "name": "Test Student"}
+        self.courses = [{"id": 100 + c, "name": f"CS {400 + c} Course {c}"} for c in range(courses)]
+        self.assignments = {}
+        self.submissions = {}
+        self.files = {}
+        self.announcements = {}
+        for course in self.courses:
+            course_id = course["id"]
+            self.assignments[course_id] = [
+                {
+                    "id": course_id * 1000 + a,
+                    "course_id": course_id,
+                    "name": f"Assignment {a}",
+                    "points_possible": 100,
+                    # Spread due dates from two weeks ago to four weeks out
+                    "due_at": iso(now + timedelta(hours=12 * a - 24 * 14)),
+                    "html_url": f"https://canvas.example/courses/{course_id}/assignments/{course_id * 1000 + a}",
+                    "submission": {"grade": None, "submitted_at": None},
+                }
+                for a in range(assignments)
+            ]
+            self.submissions[course_id] = [
+                {
+                    "id": course_id * 100000 + s,
+                    "assignment_id": course_id * 1000 + (s % assignments),
+                    "user_id": self.user["id"],
+                    "grade": str(70 + s % 30),
+                    "score": 70 + s % 30,
+                    # One graded every six hours, newest first
+                    "graded_at": iso(now - timedelta(hours=6 * s)),
+                    "preview_url": f"https://canvas.example/courses/{course_id}/submissions/{s}",
+                    "submission_comments": [
+                        {"author_name": "Instructor", "created_at": iso(now - timedelta(hours=6 * s)), "comment": "Nice work"}
+                    ],
+                }
+                for s in range(submissions)
+            ]
+            self.files[course_id] = [
+                {
+                    "id": course_id * 10000 + f,
+                    "display_name": f"lecture_{f}.pdf",
+                    "url": f"https://canvas.example/files/{course_id * 10000 + f}",
+                    "created_at": iso(now - timedelta(days=f)),
+                }
+                for f in range(files)
+            ]
+            self.announcements[course_id] = [
+                {
+                    "id": course_id * 10000 + n,
+                    "title": f"Announcement {n}",
+                    "message": "<p>Reminder: <b>midterm</b> on <a href='https://canvas.example'>Friday</a></p>" * 5,
+                    "posted_at": iso(now - timedelta(days=n)),
+                }
+                for n in range(announcements)
+            ]
+        self.conversations = [
+            {
+                "id": 900000 + m,
+                "subject": f"Question {m}",
+                "last_message": "Can we meet after class?",
+                # Canvas sorts the inbox by last activity, newest first
+                "last_message_at": iso(now - timedelta(hours=m)),
+                "participants": [{"name": "Classmate"}],
+            }
+            for m in range(conversations)
+        ]
+
+    # Response helpers
+    def _page(self, request, items):
+        per_page = int(request.query.get("per_page", self.default_per_page))
+        page = int(request.query.get("page", 1))
+        start = (page - 1) * per_page
+        body = items[start:start + per_page]
+
+        headers = {}
+        if start + per_page < len(items):
+            query = [(key, value) for key, value in request.query.items() if key not in ("page", "per_page")]
+            query += [("page", str(page + 1)), ("per_page", str(per_page))]
+            next_url = request.url.with_query(query)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+        return self._json(request, body, headers)
+
+    def _json(self, request, body, headers=None):
+        text = json.dumps(body)
+        etag = '"' + hashlib.md5(text.encode()).hexdigest() + '"'
+        headers = dict(headers or {})
+        headers["ETag"] = etag
+        headers["X-Rate-Limit-Remaining"] = "700.0"
+        headers["X-Request-Cost"] = "1.0"
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(text=text, content_type="application/json", headers=headers)
+
+    def _assignment(self, course_id, assignment_id):
+        for assignment in self.assignments.get(course_id, []):
+            if assignment["id"] == assignment_id:
+                return assignment
+        return None
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    # Handlers
+    async def courses_handler(self, request):
+        return self._page(request, self.courses)
+
+    async def assignments_handler(self, request):
+        course_id = int(request.match_info["course_id"])
+        assignments = self.assignments.get(course_id, [])
+        if request.query.get("bucket") == "future":
+            now = iso(datetime.now(timezone.utc))
+            assignments = [a for a in assignments if a["due_at"] >= now]
+        if request.query.get("order_by") == "due_at":
+            assignments = sorted(assignments, key=lambda a: a["due_at"])
+        return self._page(request, assignments)
+
+    async def assignment_handler(self, request):
+        course_id = int(request.match_info["course_id"])
+        assignment = self._assignment(course_id, int(request.match_info["assignment_id"]))
+        if assignment is None:
+            return web.Response(status=404)
+        return self._json(request, assignment)
+
+    async def submissions_handler(self, request):
+        course_id = int(request.match_info["course_id"])
+        graded_since = request.query.get("graded_since")
+        includes = request.query.getall("include[]", [])
+        submissions = []
+        for submission in self.submissions.get(course_id, []):
+            if graded_since and submission["graded_at"] < graded_since:
+                continue
+            item = dict(submission)
+            if "submission_comments" not in includes:
+                item.pop("submission_comments")
+            if "assignment" in includes:
+                item["assignment"] = self._assignment(course_id, submission["assignment_id"])
+            if "user" in includes:
+                item["user"] = self.user
+            submissions.append(item)
+        return self._page(request, submissions)
+
+    async def submission_handler(self, request):
+        course_id = int(request.match_info["course_id"])
+        assignment_id = int(request.match_info["assignment_id"])
+        for submission in self.submissions.get(course_id, []):
+            if submission["assignment_id"] == assignment_id:
+                return self._json(request, submission)
+        return web.Response(status=404)
+
+    async def files_handler(self, request):
+        course_id = int(request.match_info["course_id"])
+        files = sorted(self.files.get(course_id, []), key=lambda f: f["created_at"],
+                       reverse=request.query.get("order") == "desc")
+        return self._page(request, files)
+
+    async def announcements_handler(self, request):
+        announcements = []
+        for context_code in request.query.getall("context_codes[]", []):
+            course_id = int(context_code.split("_", 1)[1])
+            announcements += self.announcements.get(course_id, [])
+        return self._page(request, announcements)
+
+    async def conversations_handler(self, request):
+        return self._page(request, self.conversations)
+
+    async def course_enrollments_handler(self, request):
+        # The whole roster, like Canvas returns for /courses/:id/enrollments
+        course_id = int(request.match_info["course_id"])
+        roster = [
+            {"course_id": course_id, "user_id": user_id, "type": "StudentEnrollment",
+             "grades": {"current_score": 60 + user_id % 40}}
+            for user_id in range(1, 201)
+        ]
+        return self._page(request, roster)
+
+    async def self_enrollments_handler(self, request):
+        enrollments = [
+            {"course_id": course["id"], "user_id": self.user["id"], "type": "StudentEnrollment",
+             "grades": {"current_score": 80 + index % 20}}
+            for index, course in enumerate(self.courses)
+        ]
+        return self._page(request, enrollments)
+
+    async def user_handler(self, request):
+        return self._json(request, self.user)
+
+    def app(self):
+        app = web.Application(middlewares=[self._middleware])
+        routes = [
+            ("/api/v1/courses", self.courses_handler),
+            ("/api/v1/courses/{course_id}/assignments", self.assignments_handler),
+            ("/api/v1/courses/{course_id}/assignments/{assignment_id}", self.assignment_handler),
+            ("/api/v1/courses/{course_id}/assignments/{assignment_id}/submissions/{user_id}", self.submission_handler),
+            ("/api/v1/courses/{course_id}/students/submissions", self.submissions_handler),
+            ("/api/v1/courses/{course_id}/files", self.files_handler),
+            ("/api/v1/courses/{course_id}/enrollments", self.course_enrollments_handler),
+            ("/api/v1/announcements", self.announcements_handler),
+            ("/api/v1/conversations", self.conversations_handler),
+            ("/api/v1/users/self/enrollments", self.self_enrollments_handler),
+            ("/api/v1/users/{user_id}", self.user_handler),
+        ]
+        for path, handler in routes:
+            app.router.add_get(path, handler)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,185 @@
+"""
+Replays recorded Canvas Live Events payloads against the bot's push receiver.
+
+By default every payload in bench/events/ (or the files given) is POSTed to a running
+receiver and the response is printed:
+    python bench/replay_events.py --url http://127.0.0.1:9109/events
+
+With --local the whole path runs in-process: a mock Canvas, the bot with stubbed Discord
+objects and the receiver are started, existing Canvas items are marked seen, and then each
+payload is posted and timed until its notification reaches the delivery queue's stub
+recipients. It also shows polling dropping to reconciliation intervals once push is healthy:
+    python bench/replay_events.py --local
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("payloads", nargs="*", help="JSON files to post, defaults to bench/events/*.json")
+    parser.add_argument("--url", default="http://127.0.0.1:9109/events")
+    parser.add_argument("--secret", default=os.environ.get("PUSH_SECRET"))
+    parser.add_argument("--local", action="store_true", help="run a mock Canvas and the bot in-process")
+    parser.add_argument("--port", type=int, default=8799, help="mock Canvas port for --local")
+    parser.add_argument("--push-port", type=int, default=9109, help="receiver port for --local")
+    parser.add_argument("--subscribers", type=int, default=5)
+    args = parser.parse_args()
+    # --local moves into a scratch directory, so resolve the payload paths first
+    args.payloads = [os.path.abspath(path) for path in args.payloads]
+    return args
+
+
+def load_payloads(paths):
+    paths = paths or sorted(glob.glob(os.path.join(BENCH_DIR, "events", "*.json")))
+    payloads = []
+    for path in paths:
+        with open(path, "r") as file:
+            payloads.append((os.path.basename(path), json.load(file)))
+    return payloads
+
+
+async def post(session, url, payload, secret):
+    headers = {"X-Push-Secret": secret} if secret else {}
+    async with session.post(url, json=payload, headers=headers) as response:
+        try:
+            body = await response.json()
+        except aiohttp.ContentTypeError:
+            body = await response.text()
+        return response.status, body
+
+
+async def replay(args):
+    async with aiohttp.ClientSession() as session:
+        for name, payload in load_payloads(args.payloads):
+            status, body = await post(session, args.url, payload, args.secret)
+            print(f"{name:<40}{status:>5}  {body}")
+
+
+def seed_mock(canvas, payload):
+    # Make the mock Canvas return the item a file or message event refers to, like real Canvas would
+    metadata = payload.get("metadata", {})
+    body = payload.get("body", {})
+    # A second ahead so it sorts before the mock's newest file, which was created "now" too
+    now = (datetime.now(timezone.utc) + timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    if metadata.get("event_name") == "attachment_created":
+        course_id = int(metadata["context_id"])
+        canvas.files[course_id].append({
+            "id": int(body["attachment_id"]),
+            "display_name": body["display_name"],
+            "url": f"https://canvas.example/files/{body['attachment_id']}",
+            "created_at": now,
+        })
+    elif metadata.get("event_name") == "conversation_message_created":
+        canvas.conversations.insert(0, {
+            "id": int(body["conversation_id"]),
+            "subject": "Study group tonight?",
+            "last_message": "Meet in the library at 7",
+            "last_message_at": now,
+            "participants": [{"name": "Classmate"}],
+        })
+
+
+async def replay_local(args):
+    from mock_canvas import MockCanvas
+    from stub_discord import StubChannel, StubGuild, attach, delivered
+
+    canvas = MockCanvas(courses=3, submissions=10, files=5, announcements=3, conversations=5, latency=0.01, port=args.port)
+
+    # The bot reads its config at import time, so point it at the mock and a scratch directory first
+    workdir = tempfile.mkdtemp(prefix="canvas-push-")
+    os.chdir(workdir)
+    os.environ["CANVAS_API_URL"] = canvas.base_url
+    os.environ["CANVAS_API_TOKEN"] = "replay-token"
+    os.environ["BOT_STATE_DB"] = os.path.join(workdir, "bot_state.db")
+    os.environ["DELIVERY_COALESCE_SECONDS"] = "0.05"
+    os.environ["DELIVERY_MIN_SEND_INTERVAL"] = "0"
+    # Keep scheduled polls out of the way, only pushed events should trigger work
+    os.environ["POLL_MIN_INTERVAL"] = "3600"
+    os.environ["POLL_MAX_INTERVAL"] = "7200"
+    if args.secret:
+        os.environ["PUSH_SECRET"] = args.secret
+
+    import ApiUtil as au
+    import DiscordBot as db
+    from PreferenceStore import CHANNEL, MEMBER, category_mask
+
+    guild = StubGuild(20)
+    channel = StubChannel(2)
+    attach(db.bot, guild, channel)
+
+    await canvas.start()
+    await au.fetch_student_courses()
+    db.delivery_queue.start()
+
+    for member in guild.members[:args.subscribers]:
+        db.preferences.set(MEMBER, member.id, category_mask(["Grades", "Announcements", "Messages"]))
+    db.preferences.set(CHANNEL, channel.id, category_mask(["Files"]))
+
+    # Cold start: the first pass only records what's already in Canvas, nothing is sent
+    await db.announce_grades()
+    await db.notify_inbox_messages()
+    await db.check_new_announcements()
+    await db.notify_new_files()
+    await asyncio.sleep(0.2)
+    print(f"cold start sent {delivered(guild, channel)} notifications")
+
+    await db.push_receiver.start(port=args.push_port)
+    # Pushed events go through the polling workers too when POLL_PROCESSES is set
+    db.poll_workers.start()
+    await db.sync_poll_jobs()
+    db.start_polling()
+    url = f"http://127.0.0.1:{args.push_port}/events"
+
+    print(f"{'payload':<40}{'status':>7}{'http':>6}{'sent':>6}{'latency ms':>12}")
+    async with aiohttp.ClientSession() as session:
+        for name, payload in load_payloads(args.payloads):
+            seed_mock(canvas, payload)
+            canvas.calls.clear()
+            sent_before = delivered(guild, channel)
+            start = time.perf_counter()
+            status, body = await post(session, url, payload, args.secret)
+
+            # Wait for the notification to come out of the delivery queue, ignored events never will
+            latency = None
+            while time.perf_counter() - start < 3:
+                if delivered(guild, channel) > sent_before:
+                    latency = time.perf_counter() - start
+                    break
+                await asyncio.sleep(0.005)
+            await asyncio.sleep(0.1)
+            latency_text = f"{latency * 1000:.0f}" if latency is not None else "-"
+            print(f"{name:<40}{status:>7}{sum(canvas.calls.values()):>6}"
+                  f"{delivered(guild, channel) - sent_before:>6}{latency_text:>12}")
+
+    await db.check_push_health()
+    course_job = next(job for key, job in db.poll_scheduler.jobs.items() if key[2] == "grades")
+    print(f"push healthy: {db.push_receiver.healthy()}, course poll interval now "
+          f"{course_job.min_interval}-{course_job.max_interval}s, receiver {db.push_receiver.stats()}")
+
+    await db.poll_scheduler.stop()
+    await db.poll_workers.stop()
+    await db.push_receiver.stop()
+    await db.delivery_queue.stop()
+    await au.close_canvas_client()
+    db.seen_store.close()
+    db.preferences.close()
+    db.account_store.close()
+    await canvas.stop()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    asyncio.run(replay_local(arguments) if arguments.local else replay(arguments))
@@ -0,0 +1,52 @@
+"""
+Stand-ins for the Discord objects the notification code touches (guild, members, channel).
+Sends are recorded instead of going to Discord, with an optional fake send latency.
+"""
+import asyncio
+
+
+class StubRecipient:
+    def __init__(self, recipient_id, send_latency=0.0):
+        self.id = recipient_id
+        self.send_latency = send_latency
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent.append(content if content is not None else kwargs)
+
+
+class StubMember(StubRecipient):
+    def __init__(self, member_id, bot=False, send_latency=0.0):
+        super().__init__(member_id, send_latency)
+        self.bot = bot
+        self.name = f"member{member_id}"
+
+    def __str__(self):
+        return self.name
+
+
+class StubChannel(StubRecipient):
+    def __str__(self):
+        return f"channel{self.id}"
+
+
+class StubGuild:
+    def __init__(self, member_count=50, send_latency=0.0):
+        self.id = 1
+        self.members = [StubMember(member_id, send_latency=send_latency) for member_id in range(1, member_count + 1)]
+        self._members = {member.id: member for member in self.members}
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+
+def attach(bot, guild, channel):
+    # Point the bot's guild/channel lookups at the stubs
+    bot.get_guild = lambda guild_id: guild
+    bot.get_channel = lambda channel_id: channel
+
+
+def delivered(guild, channel):
+    return sum(len(member.sent) for member in guild.members) + len(channel.sent)
@@ -3,12 +3,14 @@ import discord
 from discord.ext import commands, tasks
 
 import ApiUtil as au
+from Metrics import metrics
+from PreferenceStore import CHANNEL, CATEGORY_BITS, category_mask, category_names
+import TimeUtil
 
 class Commands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.user = bot.user
-        self.channel_preferences = {}
 
     @commands.command()
     async def test(self, ctx):
@@ -77,16 +79,15 @@ class Commands(commands.Cog):
         channel_id = ctx.channel.id
 
         # Validate preferences
-        valid_preferences = {"grades", "announcements", "messages"}
-        selected_preferences = set(preferences).intersection(valid_preferences)
+        selected = category_mask(preferences)
 
-        if not selected_preferences:
-            await ctx.send(f"Invalid preferences! Choose from: {', '.join(valid_preferences)}")
+        if not selected:
+            await ctx.send(f"Invalid preferences! Choose from: {', '.join(name.lower() for name in CATEGORY_BITS)}")
             return
 
-        # Save preferences
-        self.channel_preferences[channel_id] = selected_preferences
-        await ctx.send(f"Preferences for this channel updated: {', '.join(selected_preferences)}")
+        # Save preferences, notifications for these categories are posted in this channel
+        self.bot.preferences.set(CHANNEL, channel_id, selected)
+        await ctx.send(f"Preferences for this channel updated: {', '.join(category_names(selected)).lower()}")
 
     # view_preferences command
     @commands.command()
@@ -96,9 +97,9 @@ class Commands(commands.Cog):
         Usage: !view_preferences
         """
         channel_id = ctx.channel.id
-        preferences = self.channel_preferences.get(channel_id, "None set")
+        preferences = category_names(self.bot.preferences.get(CHANNEL, channel_id))
         await ctx.send(
-            f"Current preferences for this channel: {', '.join(preferences) if preferences != 'None set' else preferences}")
+            f"Current preferences for this channel: {', '.join(preferences).lower() if preferences else 'None set'}")
 
     # available_preferences command
     @commands.command()
@@ -107,8 +108,59 @@ class Commands(commands.Cog):
         View the available preferences to set.
         Usage: !available_preferences
         """
-        valid_preferences = {"grades", "announcements", "messages"}
-        await ctx.send(f"Available preferences to set: {', '.join(valid_preferences)}")
+        await ctx.send(f"Available preferences to set: {', '.join(name.lower() for name in CATEGORY_BITS)}")
+
+    # timezone command
+    @commands.command()
+    async def timezone(self, ctx, name: str = None):
+        """
+        View or set the timezone your due dates and grade times are shown in.
+        Usage: !timezone [name] Example: !timezone America/Denver
+        """
+        if not name:
+            await ctx.send(f"Your timezone is: {TimeUtil.timezone_for(ctx.author.id).zone}")
+            return
+        if not TimeUtil.set_user_timezone(ctx.author.id, name):
+            await ctx.send(f"Unknown timezone {name}! Use a name like America/Los_Angeles or America/New_York")
+            return
+        self.bot.preferences.set_timezone(ctx.author.id, name)
+        await ctx.send(f"Your timezone is now: {name}")
+
+    # link_canvas command
+    @commands.command()
+    async def link_canvas(self, ctx, token: str = None):
+        """
+        Use your own Canvas access token for your grades, messages and classes. DM the bot to use it.
+        Usage: !link_canvas <token>
+        """
+        if ctx.guild is not None:
+            # Don't leave a token sitting in a server channel
+            try:
+                await ctx.message.delete()
+            except (discord.Forbidden, discord.HTTPException):
+                pass
+            await ctx.send(f"{ctx.author.mention} please send !link_canvas to me in a DM, never post your token in a server!")
+            return
+        if not token:
+            await ctx.send("Please provide your Canvas access token (Account > Settings > New Access Token)")
+            return
+        account = await au.link_account(ctx.author.id, token, self.bot.account_store)
+        if account is None:
+            await ctx.send("Canvas didn't accept that token, please check it and try again.")
+            return
+        await ctx.send(f"Your Canvas account is linked! Found {len(au.get_course_ids(account))} classes.")
+
+    # unlink_canvas command
+    @commands.command()
+    async def unlink_canvas(self, ctx):
+        """
+        Stop using your own Canvas token and forget it.
+        Usage: !unlink_canvas
+        """
+        if await au.unlink_account(ctx.author.id, self.bot.account_store):
+            await ctx.send("Your Canvas account is unlinked and your token was removed.")
+        else:
+            await ctx.send("You don't have a linked Canvas account.")
 
     # get_classes command
     # have to hard code this for now
@@ -206,7 +258,7 @@ class Commands(commands.Cog):
         Usage: !get_gpa
         """
         #await ctx.send("Your current GPA is: 3.26")
-        gpa, average_percentage = au.calculate_gpa()
+        gpa, average_percentage = await au.calculate_gpa(au.account_for(ctx.author.id))
         try:
             await ctx.author.send(f"Your current GPA is: {gpa}")
             await ctx.send(f"✅ Message sent to {ctx.author.name}.")
@@ -217,6 +269,83 @@ class Commands(commands.Cog):
             await ctx.send(f"❌ Could not send a DM to {ctx.author.name}. Error: {str(e)}")
 
 
+    # admin stats command
+    @commands.command()
+    @commands.has_permissions(administrator=True)
+    async def stats(self, ctx):
+        """
+        ADMIN USE, shows Canvas request, cache, polling and delivery stats.
+        Usage: !stats
+        """
+        lines = ["**Canvas requests** (endpoint: requests, cost, avg latency)"]
+        requests_by_endpoint = metrics.by_label("canvas_requests_total", "endpoint")
+        cost_by_endpoint = metrics.by_label("canvas_request_cost_total", "endpoint")
+        latency_by_endpoint = metrics.histogram_summary("canvas_request_seconds", "endpoint")
+        for endpoint, count in sorted(requests_by_endpoint.items(), key=lambda item: -item[1])[:8]:
+            latency = latency_by_endpoint.get(endpoint, {"sum": 0, "count": 0})
+            average_ms = latency["sum"] / latency["count"] * 1000 if latency["count"] else 0
+            lines.append(f"`{endpoint}`: {count:.0f}, {cost_by_endpoint.get(endpoint, 0):.1f}, {average_ms:.0f} ms")
+
+        cost_by_course = metrics.by_label("canvas_request_cost_total", "course")
+        top_courses = sorted(((course, cost) for course, cost in cost_by_course.items() if course), key=lambda item: -item[1])[:5]
+        if top_courses:
+            lines.append("**Rate-limit cost by course:** " + ", ".join(
+                f"{au.get_course_by_id(int(course)) or course} {cost:.1f}" for course, cost in top_courses
+            ))
+
+        rate_limit = au.get_rate_limit_state()
+        lines.append(
+            f"**Rate limit:** {rate_limit['remaining'] if rate_limit['remaining'] is not None else 'unknown'} remaining, "
+            f"{rate_limit['throttled']} throttled, {rate_limit['retries']} retries, "
+            f"{len(au.linked_accounts())} linked accounts"
+        )
+
+        lines.append("**Caches:** " + ", ".join(
+            f"{name} {stats['hit_rate']:.0%} of {stats['hits'] + stats['misses']}"
+            for name, stats in au.get_cache_stats().items()
+        ))
+
+        scheduler = getattr(self.bot, "poll_scheduler", None)
+        if scheduler is not None:
+            jobs = scheduler.stats()
+            if jobs:
+                slowest = max(jobs, key=lambda job: job["last_duration"] or 0)
+                lines.append(
+                    f"**Polling:** {len(jobs)} jobs, worst lag {max(job['lag'] for job in jobs):.1f}s, "
+                    f"slowest {slowest['key']} {slowest['last_duration'] or 0:.2f}s, "
+                    f"{sum(job['events'] for job in jobs)} events"
+                )
+
+        workers = getattr(self.bot, "poll_workers", None)
+        if workers is not None and workers.running:
+            worker_stats = workers.stats()
+            lines.append(
+                f"**Workers:** {worker_stats['alive']}/{worker_stats['processes']} alive, "
+                f"jobs {', '.join(str(count) for count in worker_stats['jobs'])}, "
+                f"{worker_stats['pending']} pending, {worker_stats['restarts']} restarts"
+            )
+
+        delivery = getattr(self.bot, "delivery_queue", None)
+        if delivery is not None:
+            delivery_stats = delivery.stats()
+            latency = metrics.histogram_summary("delivery_latency_seconds", "recipient")
+            count = sum(entry["count"] for entry in latency.values())
+            average = sum(entry["sum"] for entry in latency.values()) / count if count else 0
+            lines.append(
+                f"**Delivery:** {delivery_stats['sent']} sent, {delivery_stats['failed']} failed, "
+                f"{delivery_stats['pending']} pending, avg latency {average:.1f}s"
+            )
+
+        push = getattr(self.bot, "push_receiver", None)
+        if push is not None and push.running:
+            push_stats = push.stats()
+            lines.append(
+                f"**Push:** {'healthy' if push_stats['healthy'] else 'quiet'}, {push_stats['received']} events, "
+                f"{push_stats['ignored']} ignored, {push_stats['failed']} failed"
+            )
+
+        await ctx.send("\n".join(lines)[:2000])
+
     # Command: Start Menu
     @commands.command(name="menu")
     async def menu(self, ctx):